@@ -0,0 +1,83 @@
+import argparse
+import tomllib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Optional
+
+import catalogue_export
+from pipeline import Reduction
+
+# Headless reduction without GUI: python batch.py field1.toml field2.toml ... [--fields N] [--append catalogues.fits]
+
+
+def reduce_field(path_config: Path | str, collect: bool = False) -> tuple[str, Optional[tuple[dict, dict]]]:
+    """
+    Runs the full reduction of the field configured in path_config and writes master fits and the colour magnitude table
+    With collect, the table is returned as well (columns and meta, see catalogue_export), e.g. to append it to one file
+    """
+    with open(path_config, "rb") as fl:
+        input_cmd = tomllib.load(fl)
+
+    reduction = Reduction(input_cmd, warn=lambda title, text: print(f"{path_config}: {title}: {text}"))
+
+    try:
+        if not reduction.run():
+            return f"{path_config}: no lights found, skipped", None
+
+        mag_short, mag_long = reduction.calibration.magnitudes()
+        save_files = reduction.save_fhd_file(mag_short, mag_long)
+
+        catalogue = None
+        if collect:
+            catalogue = catalogue_export.catalogue_columns(reduction, mag_short, mag_long), catalogue_export.catalogue_meta(reduction)
+    finally:
+        reduction.executor.shutdown()
+
+    return f"{path_config}: {reduction.n_stars_min} stars written to {', '.join(str(f) for f in save_files)}", catalogue
+
+
+def field_name(path_config: Path) -> str:
+    """
+    Name of the extension of a field in the appended file: path of its config relative to the working directory, without suffix
+    Fields with one directory each and the same config file name (e.g. field1/input_cmd.toml) get distinct names
+    """
+    path, cwd = Path(path_config).resolve(), Path.cwd().resolve()
+    if path.is_relative_to(cwd):
+        path = path.relative_to(cwd)
+    return path.with_suffix("").as_posix()
+
+
+def report(path_config: Path, message: str, catalogue: Optional[tuple[dict, dict]], path_append: Optional[Path]):
+    """Prints the result of a field and appends its table to path_append (in the main process only, appending is not concurrent)"""
+    print(message)
+    if path_append is not None and catalogue is not None:
+        catalogue_export.append_fits(path_append, *catalogue, name=field_name(path_config))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reduce fields without GUI, one input_cmd.toml per field")
+    parser.add_argument("configs", nargs="+", type=Path, help="input_cmd.toml files of the fields")
+    parser.add_argument("--fields", type=int, default=1, help="number of fields reduced concurrently")
+    parser.add_argument("--append", type=Path, default=None, help="multi-extension fits file, the table of every field is appended to")
+    args = parser.parse_args()
+    collect = args.append is not None
+
+    if args.fields <= 1:
+        for path_config in args.configs:
+            try:
+                report(path_config, *reduce_field(path_config, collect), args.append)
+            except Exception as e:
+                print(f"{path_config}: failed ({e!r})")
+        return
+
+    with ProcessPoolExecutor(max_workers=args.fields) as pool:
+        futures = {pool.submit(reduce_field, path_config, collect): path_config for path_config in args.configs}
+        for future in as_completed(futures):
+            try:
+                report(futures[future], *future.result(), args.append)
+            except Exception as e:
+                print(f"{futures[future]}: failed ({e!r})")
+
+
+if __name__ == "__main__":
+    main()
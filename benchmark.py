@@ -0,0 +1,268 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from astropy.stats import sigma_clipped_stats
+
+import util
+import synthetic
+from pipeline import Reduction
+from photutils.aperture import CircularAperture, aperture_photometry
+
+import argparse
+import itertools
+import json
+import platform
+import subprocess
+import tempfile
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+
+
+def bench_alignment(shape=(2048, 2048), n_frames=6, downsample=1):
+    """Times util.get_offset on a stack of shifted frames with random point sources"""
+    rng = np.random.default_rng(0)
+    base = rng.normal(100, 5, shape)
+    points = rng.integers(10, min(shape) - 10, (3000, 2))
+    base[points[:, 0], points[:, 1]] += 1000
+    scidata = np.array([np.roll(base, (i, -i), axis=(0, 1)) for i in range(n_frames)])
+    _, median, std = util.get_stats(scidata)
+
+    start = perf_counter()
+    util.get_offset(scidata, median, std, downsample=downsample)
+    return perf_counter() - start
+
+
+def bench_stats(shape=(10, 2048, 2048), max_pixels=None):
+    """Times util.get_stats on a stack and astropy's sigma_clipped_stats frame by frame as reference"""
+    rng = np.random.default_rng(0)
+    scidata = rng.normal(100, 5, shape)
+
+    start = perf_counter()
+    util.get_stats(scidata, max_pixels=max_pixels)
+    vectorized = perf_counter() - start
+
+    start = perf_counter()
+    for frame in scidata:
+        sigma_clipped_stats(frame, sigma=3.0)
+    return vectorized, perf_counter() - start
+
+
+def bench_shift(shape=(20, 2048, 2048), subpixel=False):
+    """Times util.shift_data on a stack with random offsets"""
+    rng = np.random.default_rng(0)
+    scidata = rng.normal(size=shape)
+    offset = rng.integers(-10, 10, (shape[0], 2))
+    if subpixel:
+        offset = offset + rng.uniform(-0.5, 0.5, offset.shape)
+
+    start = perf_counter()
+    util.shift_data(scidata, offset)
+    return perf_counter() - start
+
+
+def bench_photometry(shape=(2, 4096, 4096), n_stars=20000, radius=4., annulus=None):
+    """Throughput of util.photometry (stars per second, all frames) and of photutils frame by frame as reference"""
+    rng = np.random.default_rng(0)
+    scidata = rng.normal(100, 5, shape)
+    positions = rng.uniform(20, min(shape[1:]) - 20, (shape[0], n_stars, 2))
+    median = np.full(shape[0], 100.)
+    std = np.full(shape[0], 5.)
+
+    start = perf_counter()
+    util.photometry(scidata, median, std, positions, radius, annulus)
+    batched = n_stars * shape[0] / (perf_counter() - start)
+
+    start = perf_counter()
+    for data, xy, sky in zip(scidata, positions, median):
+        aperture_photometry(data - sky, CircularAperture(xy, r=radius))
+    reference = n_stars * shape[0] / (perf_counter() - start)
+
+    return batched, reference
+
+
+def compare_truth(reduction: Reduction, truth: dict, tolerance: float = 1.5) -> dict:
+    """
+    Detected stars matched to the injected ones within tolerance pixels
+    completeness of all and of the brighter half of the injected stars, positional rms and measured / injected flux per colour
+    """
+    n_injected = len(truth["positions"])
+    distance, index = cKDTree(truth["positions"]).query(reduction.positions[reduction.reference_fit], distance_upper_bound=tolerance)
+    matched = np.isfinite(distance)
+    found = np.zeros(n_injected, dtype=bool)
+    found[index[matched]] = True
+
+    bright = truth["flux"][0] >= np.median(truth["flux"][0])
+    result = {
+        "n_injected": n_injected,
+        "n_detected": len(distance),
+        "n_spurious": int(np.count_nonzero(~matched)),
+        "completeness": float(np.mean(found)),
+        "completeness_bright": float(np.mean(found[bright])),
+        "position_rms_px": float(np.sqrt(np.mean(distance[matched] ** 2))) if np.any(matched) else None,
+    }
+
+    for c in range(2):
+        ratio = reduction.stars_flux[c, matched] / truth["flux"][c, index[matched]]
+        result[f"flux_ratio_median_{c}"] = float(np.median(ratio)) if len(ratio) else None
+        result[f"flux_ratio_mad_{c}"] = float(np.median(np.abs(ratio - np.median(ratio)))) if len(ratio) else None
+
+    return result
+
+
+def reduce_synthetic(input_cmd: dict, trace_memory: bool = True) -> Reduction:
+    """Reduces a synthetic field headless, including the conversion for display"""
+    reduction = Reduction({**input_cmd, "trace_memory": trace_memory}, warn=lambda title, text: None)
+
+    try:
+        reduction.run()
+        with reduction.report.stage("Display"):
+            reduction.display_stretch().render()
+    finally:
+        tracemalloc.stop()
+        reduction.executor.shutdown()
+
+    return reduction
+
+
+def bench_reduction(directory: Path | str, trace_memory: bool = True, dtype: str = "float32", **field) -> dict:
+    """
+    Writes a synthetic field (see synthetic.make_field) to directory and reduces it headless
+    Returns the parameters, the measurements per stage (see RunReport) and the comparison with the injected stars
+    """
+    input_cmd, truth = synthetic.make_field(directory, **field)
+    reduction = reduce_synthetic({**input_cmd, "dtype": dtype}, trace_memory)
+
+    return {
+        "field": {k: list(v) if isinstance(v, tuple) else v for k, v in field.items()},
+        "dtype": dtype,
+        "stages": reduction.report.stages,
+        "total_wall_s": reduction.report.total_wall_s,
+        "accuracy": compare_truth(reduction, truth),
+    }
+
+
+def bench_dtype(directory: Path | str, **field) -> dict:
+    """
+    Reduces the same synthetic field in float64 and float32
+    Returns peak traced memory and time of both and the differences of the instrumental magnitudes of the stars found by both
+    """
+    input_cmd, _ = synthetic.make_field(directory, **field)
+    reductions = {dtype: reduce_synthetic({**input_cmd, "dtype": dtype}) for dtype in ("float64", "float32")}
+    reference, reduced = reductions["float64"], reductions["float32"]
+
+    distance, index = cKDTree(reference.positions[reference.reference_fit]).query(reduced.positions[reduced.reference_fit], distance_upper_bound=0.5)
+    matched = np.isfinite(distance)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        delta_mag = np.abs(2.5 * np.log10(reduced.stars_flux[:, matched] / reference.stars_flux[:, index[matched]]))
+
+    return {
+        "field": {k: list(v) if isinstance(v, tuple) else v for k, v in field.items()},
+        "n_stars": {dtype: reduction.n_stars_min for dtype, reduction in reductions.items()},
+        "n_matched": int(np.count_nonzero(matched)),
+        "delta_mag_median": float(np.nanmedian(delta_mag)),
+        "delta_mag_max": float(np.nanmax(delta_mag)),
+        "peak_traced_mb": {dtype: max(stage["peak_traced_mb"] for stage in reduction.report.stages) for dtype, reduction in reductions.items()},
+        "total_wall_s": {dtype: reduction.report.total_wall_s for dtype, reduction in reductions.items()},
+    }
+
+
+def environment() -> dict:
+    """Versions the results belong to"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=Path(__file__).parent).stdout.strip()
+    except OSError:
+        commit = ""
+
+    return {"date": datetime.now().isoformat(timespec="seconds"), "commit": commit or None,
+            "python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine()}
+
+
+def run_micro():
+    """Times single util functions on random data"""
+    print(f"alignment 6x2048x2048: {bench_alignment():.3f} s")
+    print(f"alignment 6x2048x2048, downsample 4: {bench_alignment(downsample=4):.3f} s")
+    print("statistics 10x2048x2048: {:.3f} s (astropy: {:.3f} s)".format(*bench_stats()))
+    print(f"statistics 10x2048x2048, 1e6 pixels per frame: {bench_stats(max_pixels=1_000_000)[0]:.3f} s")
+    print(f"shift 20x2048x2048: {bench_shift():.3f} s")
+    print(f"shift 20x2048x2048, sub-pixel: {bench_shift(subpixel=True):.3f} s")
+    print("photometry 2x4096x4096, 20000 stars: {:.0f} stars/s (photutils: {:.0f} stars/s)".format(*bench_photometry()))
+    print("photometry with sky annulus: {:.0f} stars/s".format(bench_photometry(annulus=(6., 9.))[0]))
+
+
+def run_pipeline(args: argparse.Namespace):
+    """Reduces a synthetic field for every combination of the given parameters, appends one JSON line per field to args.output"""
+    env = environment()
+    fields = itertools.product(args.size, args.density, args.fwhm, args.noise)
+
+    for size, density, fwhm, noise in fields:
+        field = {"shape": (size, size), "n_frames": (args.frames, args.frames), "density": density, "fwhm": fwhm,
+                 "dither": args.dither, "read_noise": noise, "dark": args.dark, "vignetting": args.vignetting, "seed": args.seed}
+
+        with tempfile.TemporaryDirectory(dir=args.scratch) as directory:
+            record = {**env, **bench_reduction(directory, not args.no_memory, args.dtype, **field)}
+
+        accuracy = record["accuracy"]
+        print(f"{size}x{size}, {args.frames}+{args.frames} frames, density {density:g}, FWHM {fwhm:g}, noise {noise:g}, {args.dtype}: "
+              f"{record['total_wall_s']:.2f} s, {accuracy['n_detected']}/{accuracy['n_injected']} stars, "
+              f"flux ratio {accuracy['flux_ratio_median_0']:.4f}")
+        for stage in record["stages"]:
+            peak = f", peak {stage['peak_traced_mb']:.0f} MB" if stage["peak_traced_mb"] is not None else ""
+            print(f"    {stage['stage']}: {stage['wall_s']:.3f} s (CPU {stage['cpu_s']:.3f} s{peak})")
+
+        if args.output is not None:
+            with open(args.output, "a") as fl:
+                fl.write(json.dumps(record) + "\n")
+
+
+def run_dtype(args: argparse.Namespace):
+    """Compares float32 with float64 reductions of a synthetic field per size, appends one JSON line per size to args.output"""
+    env = environment()
+
+    for size in args.size:
+        field = {"shape": (size, size), "n_frames": (args.frames, args.frames), "density": args.density[0], "fwhm": args.fwhm[0],
+                 "dither": args.dither, "read_noise": args.noise[0], "dark": args.dark, "vignetting": args.vignetting, "seed": args.seed}
+
+        with tempfile.TemporaryDirectory(dir=args.scratch) as directory:
+            record = {**env, **bench_dtype(directory, **field)}
+
+        print(f"{size}x{size}, {args.frames}+{args.frames} frames: {record['n_matched']} stars, "
+              f"|delta mag| median {record['delta_mag_median']:.2e}, max {record['delta_mag_max']:.2e}")
+        for dtype in ("float64", "float32"):
+            print(f"    {dtype}: peak {record['peak_traced_mb'][dtype]:.0f} MB, {record['total_wall_s'][dtype]:.2f} s")
+
+        if args.output is not None:
+            with open(args.output, "a") as fl:
+                fl.write(json.dumps(record) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro benchmarks of util, or reductions of synthetic fields compared with the injected stars")
+    parser.add_argument("suite", nargs="?", choices=("micro", "pipeline", "dtype"), default="micro",
+                        help="micro: single functions, pipeline: reductions of synthetic fields, dtype: float32 against float64 reductions")
+    parser.add_argument("--size", type=int, nargs="+", default=[1024], help="frame sizes in pixels (square)")
+    parser.add_argument("--frames", type=int, default=4, help="lights per colour")
+    parser.add_argument("--density", type=float, nargs="+", default=[500.], help="stars per megapixel")
+    parser.add_argument("--fwhm", type=float, nargs="+", default=[2.3], help="seeing in pixels")
+    parser.add_argument("--noise", type=float, nargs="+", default=[5.], help="read noise in ADU")
+    parser.add_argument("--dither", type=int, default=8, help="maximum offset between frames in pixels")
+    parser.add_argument("--dark", type=float, default=None, help="dark level in ADU, adds darks")
+    parser.add_argument("--vignetting", type=float, default=None, help="relative vignetting in the corners, adds flats")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dtype", default="float32", help="working dtype of the pipeline suite")
+    parser.add_argument("--no-memory", action="store_true", help="do not trace memory (tracing slows down pure Python code)")
+    parser.add_argument("--scratch", type=Path, default=None, help="directory for the synthetic fits files")
+    parser.add_argument("--output", type=Path, default=None, help="JSON lines file the results are appended to")
+    args = parser.parse_args()
+
+    match args.suite:
+        case "micro":
+            run_micro()
+        case "pipeline":
+            run_pipeline(args)
+        case "dtype":
+            run_dtype(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import numpy as np
+
+from star_catalogue import StarCatalogue
+
+
+class MagnitudeCalibration:
+    """
+    Conversion of instrumental magnitudes (-2.5 log10 flux) to the system of the labeled reference stars
+    Per colour a line is fitted: mag = slope * mag_instrumental + zero_point
+    The fit is cached and only redone, if the labeled stars or their user defined magnitudes change.
+    With robust, reference stars deviating more than sigma standard deviations are rejected iteratively.
+    Without labeled stars, magnitudes are relative to the first star, which is set to 10 mag.
+    """
+
+    def __init__(self, catalogue: StarCatalogue, robust: bool = False, sigma: float = 3., max_iter: int = 5):
+        self.catalogue = catalogue
+        self.robust = robust
+        self.sigma = sigma
+        self.max_iter = max_iter
+
+        # flux does not change, so instrumental magnitudes are computed once; nan for stars without positive flux
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.instrumental = -2.5 * np.log10(catalogue.flux)
+        self.instrumental[:, np.any(catalogue.flux <= 0, axis=0)] = np.nan
+
+        # without labeled stars, magnitudes are relative to the first star; kept per colour, so the same arrays are returned
+        self.__mag_arbitrary = tuple(self.instrumental - self.instrumental[:, :1] + 10)
+
+        self.__key = None
+        self.reference = np.empty(0, dtype=np.intp)  # indices of the labeled stars of the last fit
+        self.coefficients = None  # (2, 2): (slope, zero point) per colour
+        self.used = None  # (2, n_reference): reference stars not rejected by the fit
+        self.__mag = None
+
+    @property
+    def arbitrary_unit(self) -> bool:
+        return not np.any(self.catalogue.labeled)
+
+    def fit(self) -> np.ndarray:
+        """Fits both colours, if the labeled stars changed since the last call. Returns the coefficients"""
+        reference = np.flatnonzero(self.catalogue.labeled)
+        user_mag = self.catalogue.user_mag[:, reference]
+        key = (reference.tobytes(), user_mag.tobytes())
+
+        if key == self.__key:
+            return self.coefficients
+
+        self.coefficients = np.full((2, 2), np.nan)
+        self.used = np.zeros((2, len(reference)), dtype=bool)
+
+        if len(reference) > 0:
+            for c in range(2):
+                self.coefficients[c], self.used[c] = self.__fit_colour(self.instrumental[c, reference], user_mag[c])
+
+        self.reference = reference
+        self.__key = key
+        self.__mag = None
+
+        return self.coefficients
+
+    def __fit_colour(self, mag_instrumental: np.ndarray, mag_reference: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Linear fit of one colour, sigma-clipped if robust"""
+        valid = np.isfinite(mag_instrumental) & np.isfinite(mag_reference)
+        used = valid
+        if not np.any(used):
+            return np.full(2, np.nan), used
+
+        coefficients = np.polyfit(mag_instrumental[used], mag_reference[used], 1)
+
+        if not self.robust:
+            return coefficients, used
+
+        for _ in range(self.max_iter):
+            residuals = mag_reference - np.polyval(coefficients, mag_instrumental)
+            clipped = valid & (np.abs(residuals) <= self.sigma * np.std(residuals[used]))
+
+            # at least two stars are needed for a line
+            if np.array_equal(clipped, used) or np.count_nonzero(clipped) < 2:
+                break
+
+            used = clipped
+            coefficients = np.polyfit(mag_instrumental[used], mag_reference[used], 1)
+
+        return coefficients, used
+
+    def magnitudes(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Calibrated magnitudes (short, long) of all stars, nan for stars without positive flux
+        The same arrays are returned until the fit changes, so callers may compare them by identity
+        """
+        if self.arbitrary_unit:
+            return self.__mag_arbitrary
+
+        self.fit()
+
+        if self.__mag is None:
+            self.__mag = tuple(self.coefficients[:, :1] * self.instrumental + self.coefficients[:, 1:])
+
+        return self.__mag
+
+    def residuals(self) -> np.ndarray:
+        """(2, n_reference) user defined minus calibrated magnitudes of the labeled stars of the last fit"""
+        mag = np.vstack(self.magnitudes())
+        return self.catalogue.user_mag[:, self.reference] - mag[:, self.reference]
+
+    def summary(self, colours: tuple[str, str] = ("short", "long")) -> str:
+        if self.arbitrary_unit:
+            return "Calibration: no labeled stars, arbitrary units relative to star 0"
+
+        residuals = self.residuals()
+        lines = []
+        for c, colour in enumerate(colours):
+            slope, zero_point = self.coefficients[c]
+            rms = np.sqrt(np.mean(residuals[c, self.used[c]] ** 2))
+            lines.append(f"Calibration {colour}: slope {slope:.4f}, zero point {zero_point:.4f}, "
+                         f"rms {rms:.4f} mag, {np.count_nonzero(self.used[c])}/{len(self.reference)} stars used")
+        return "\n".join(lines)
@@ -0,0 +1,169 @@
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+
+from pathlib import Path
+from typing import Optional
+
+# file formats of write_catalogue
+FORMATS = ("dat", "fits", "npy", "npz")
+
+# leading columns of catalogue_columns in the legacy .dat layout (ID, x, y, flux and magnitude per colour)
+DAT_COLUMNS = 7
+
+# units of the .dat header as fits units
+FITS_UNITS = {"px": "pix", "ADU": "adu", "mag": "mag"}
+
+
+def catalogue_columns(reduction, mag_short: np.ndarray, mag_long: np.ndarray, selected: Optional[np.ndarray] = None) -> dict[str, np.ndarray]:
+    """
+    Columns of the colour magnitude table of the selected stars (all if selected is None) of a Reduction
+    Names are those of the .dat header, without units (see column_unit); the first DAT_COLUMNS are the legacy .dat columns
+    """
+    swc = reduction.input_cmd["short_colour"]
+    lwc = reduction.input_cmd["long_colour"]
+
+    if selected is None:
+        selected = np.arange(reduction.n_stars_min)
+
+    flux = reduction.stars_flux[:, selected]
+    flux_err = reduction.stars_flux_err[:, selected]
+
+    # error of the instrumental magnitudes
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mag_err = 2.5 / np.log(10) * flux_err / flux
+
+    xy = reduction.positions[reduction.reference_fit, selected]
+
+    return {
+        "ID": np.asarray(selected, dtype=np.int64),
+        "x": xy[:, 0], "y": xy[:, 1],
+        f"flux_{swc}": flux[0], f"flux_{lwc}": flux[1],
+        f"{swc}_mag": np.asarray(mag_short)[selected], f"{lwc}_mag": np.asarray(mag_long)[selected],
+        f"flux_err_{swc}": flux_err[0], f"flux_err_{lwc}": flux_err[1],
+        f"{swc}_mag_err": mag_err[0], f"{lwc}_mag_err": mag_err[1],
+        f"sky_{swc}": reduction.stars_sky[0, selected], f"sky_{lwc}": reduction.stars_sky[1, selected],
+        "status": reduction.catalogue.status[selected],
+    }
+
+
+def column_unit(name: str) -> str:
+    """Unit of a column as written in the .dat header, "" if it has none"""
+    if name in ("x", "y"):
+        return "px"
+    if name.startswith(("flux", "sky")):
+        return "ADU"
+    if "_mag" in name:
+        return "mag"
+    return ""
+
+
+def catalogue_meta(reduction) -> dict:
+    """Reduction parameters stored with the table, keys are valid fits header keywords"""
+    meta = {
+        "SWCOLOUR": reduction.input_cmd["short_colour"],
+        "LWCOLOUR": reduction.input_cmd["long_colour"],
+        "NSHORT": reduction.n_short_light,
+        "NLONG": reduction.n_long_light,
+        "NSTARS": reduction.n_stars_min,
+        "FWHM": reduction.input_cmd["FWHM"],
+        "RAPERT": reduction.input_cmd["r_aperture"],
+        "GAIN": reduction.input_cmd.get("gain", 1.),
+        "MAGUNIT": "arbitrary" if reduction.calibration.arbitrary_unit else "calibrated",
+    }
+
+    if not reduction.calibration.arbitrary_unit:
+        for c, colour in enumerate("SL"):
+            meta[f"{colour}SLOPE"], meta[f"{colour}ZEROPT"] = (float(v) for v in reduction.calibration.coefficients[c])
+
+    return meta
+
+
+def write_dat(path: Path, columns: dict[str, np.ndarray], meta: Optional[dict] = None):
+    """
+    Tab separated text, one header line with units in brackets (meta is not written)
+    Values are written as Python prints them, as the legacy .dat file of save_fhd_files
+    """
+    names = [f"{name}[{unit}]" if (unit := column_unit(name)) and unit != "mag" else name for name in columns]
+    # tolist gives Python int and float, whose str is the repr of the float64 values
+    rows = zip(*(np.asarray(column, dtype=np.int64 if np.issubdtype(column.dtype, np.integer) else np.float64).tolist()
+                 for column in columns.values()))
+
+    with Path(path).open("w") as fl:
+        fl.write("#" + "\t".join(names) + "\n")
+        fl.writelines("\t".join(map(str, row)) + "\n" for row in rows)
+
+
+def structured(columns: dict[str, np.ndarray]) -> np.ndarray:
+    """Columns as one structured array"""
+    table = np.empty(len(next(iter(columns.values()))), dtype=[(name, column.dtype) for name, column in columns.items()])
+    for name, column in columns.items():
+        table[name] = column
+    return table
+
+
+def write_npy(path: Path, columns: dict[str, np.ndarray], meta: Optional[dict] = None):
+    """Structured array (meta is not written)"""
+    np.save(path, structured(columns))
+
+
+def write_npz(path: Path, columns: dict[str, np.ndarray], meta: Optional[dict] = None):
+    """One array per column, meta as 0-d arrays prefixed with meta_"""
+    np.savez(path, **columns, **{f"meta_{key}": value for key, value in (meta or {}).items()})
+
+
+def table_hdu(columns: dict[str, np.ndarray], meta: Optional[dict] = None, name: Optional[str] = None) -> fits.BinTableHDU:
+    table = Table(columns, units={column_name: FITS_UNITS.get(column_unit(column_name)) for column_name in columns}, meta=meta)
+    hdu = fits.table_to_hdu(table)
+    if name is not None:
+        hdu.name = name
+    return hdu
+
+
+def write_fits(path: Path, columns: dict[str, np.ndarray], meta: Optional[dict] = None):
+    """Binary table in the first extension, meta in its header"""
+    fits.HDUList([fits.PrimaryHDU(), table_hdu(columns, meta, "CATALOGUE")]).writeto(path, overwrite=True)
+
+
+def append_fits(path: Path | str, columns: dict[str, np.ndarray], meta: Optional[dict] = None, name: Optional[str] = None) -> Path:
+    """
+    Appends the table as another extension (named name) to a multi-extension fits file, which is created if missing
+    If the file has extensions of that name already (e.g. a field appended again), EXTVER counts them up
+    Used to collect the catalogues of many fields (see batch.py); not safe for concurrent writers
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    hdu = table_hdu(columns, meta, name)
+    if path.exists():
+        if name is not None:
+            with fits.open(path) as hdul:
+                hdu.ver = 1 + sum(h.name == hdu.name for h in hdul)
+        fits.append(path, hdu.data, hdu.header)
+    else:
+        fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(path)
+
+    return path
+
+
+WRITERS = {"dat": write_dat, "fits": write_fits, "npy": write_npy, "npz": write_npz}
+
+
+def write_catalogue(path: Path | str, columns: dict[str, np.ndarray], meta: Optional[dict] = None, formats=("dat",),
+                    dat_extended: bool = False) -> list[Path]:
+    """
+    Writes the catalogue once per format, to path with the suffix of the format; returns the written files
+    The .dat file has the legacy columns only (DAT_COLUMNS), unless dat_extended
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    written = []
+    for fmt in formats:
+        if fmt not in WRITERS:
+            raise ValueError(f"Unknown catalogue format {fmt}, expected one of {', '.join(FORMATS)}")
+        file_name = path.with_suffix(f".{fmt}")
+        WRITERS[fmt](file_name, columns if fmt != "dat" or dat_extended else dict(list(columns.items())[:DAT_COLUMNS]), meta)
+        written.append(file_name)
+
+    return written
@@ -0,0 +1,96 @@
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+import os
+from collections import deque
+from typing import Callable, Iterator, Optional
+
+
+class SerialExecutor(Executor):
+    """Executor running every task directly in the calling thread. Used if no parallelism is wanted"""
+
+    workers = 1
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+    def map(self, fn, *iterables, timeout=None, chunksize=1):
+        """Lazy, so results are computed one by one while they are consumed"""
+        return map(fn, *iterables)
+
+
+def create_executor(kind: str = "serial", workers: Optional[int] = None) -> Executor:
+    """
+    Creates the executor shared by the per-frame stages (statistics, alignment, detection, photometry)
+    kind: "serial", "thread" or "process"
+    workers: number of workers, None uses the number of cores
+    The number of workers is kept as attribute workers of the executor (see n_workers)
+    """
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    match kind:
+        case "serial":
+            return SerialExecutor()
+        case "thread":
+            executor = ThreadPoolExecutor(max_workers=workers)
+        case "process":
+            executor = ProcessPoolExecutor(max_workers=workers)
+        case _:
+            raise ValueError(f"Unknown executor {kind}, expected serial, thread or process")
+
+    executor.workers = workers
+    return executor
+
+
+def n_workers(executor: Optional[Executor]) -> int:
+    """Number of workers of an executor of create_executor, 1 for None or executors created elsewhere"""
+    return getattr(executor, "workers", 1)
+
+
+def bounded_map(executor: Executor, fn, *iterables, max_pending: int) -> Iterator:
+    """
+    Results of fn in the order of iterables as executor.map, but iterables are consumed lazily:
+    at most max_pending tasks are submitted and not yet collected, executor.map would submit all at once
+    """
+    pending = deque()
+    try:
+        for args in zip(*iterables):
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+            pending.append(executor.submit(fn, *args))
+
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def map_frames(executor: Optional[Executor], fn, *iterables, progress: Optional[Callable[[int], None]] = None,
+               max_pending: Optional[int] = None) -> list:
+    """
+    Applies fn to every frame (element of iterables) using executor, serially if executor is None
+    progress(n_done) is called after each result, exceptions raised by it abort the remaining frames
+    max_pending: bounds the elements taken from iterables ahead of the results (see bounded_map), for large generated inputs
+    """
+    if executor is None:
+        results = map(fn, *iterables)
+    elif max_pending is None:
+        results = executor.map(fn, *iterables)
+    else:
+        results = bounded_map(executor, fn, *iterables, max_pending=max_pending)
+
+    if progress is None:
+        return list(results)
+
+    lst = []
+    for result in results:
+        lst.append(result)
+        progress(len(lst))
+    return lst
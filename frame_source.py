@@ -0,0 +1,91 @@
+import numpy as np
+from astropy.io import fits
+
+from pathlib import Path
+from typing import Callable, Iterator, Optional
+
+
+class FrameSource:
+    """
+    Lazy access to the frames of a list of fits files
+    Files are opened memory-mapped and read one frame (or one block of rows) at a time,
+    so only the data currently processed is resident.
+    Data will be flipped to mimic view through telescope.
+    If given, master_dark is subtracted and frames are divided by the (normalized) master_flat on reading.
+    Frames are returned as dtype (float32 is enough for 16 bit data and halves memory and bandwidth).
+    """
+
+    def __init__(self, fit_list: list[Path], master_dark: Optional[np.ndarray] = None, master_flat: Optional[np.ndarray] = None,
+                 dtype=np.float64):
+        self.fit_list = list(fit_list)
+        self.dtype = np.dtype(dtype)
+        # masters of another dtype would turn every calibrated frame into a temporary of that dtype
+        self.master_dark = master_dark.astype(self.dtype, copy=False) if master_dark is not None else None
+        self.master_flat = master_flat.astype(self.dtype, copy=False) if master_flat is not None else None
+        self.__frame_shape = None
+
+    def __len__(self) -> int:
+        return len(self.fit_list)
+
+    @property
+    def frame_shape(self) -> tuple[int, int]:
+        """Shape of one frame, read from the header of the first file"""
+        if self.__frame_shape is None:
+            header = fits.getheader(self.fit_list[0], 0)
+            self.__frame_shape = (header["NAXIS2"], header["NAXIS1"])
+        return self.__frame_shape
+
+    @property
+    def shape(self) -> tuple[int, int, int]:
+        """Shape of the stack, as if it were loaded into one array"""
+        return len(self), *self.frame_shape
+
+    def __read(self, i: int, start: int, stop: int) -> np.ndarray:
+        """Rows start:stop of the flipped and calibrated frame i"""
+        n_rows = self.frame_shape[0]
+
+        with fits.open(self.fit_list[i], memmap=True, do_not_scale_image_data=True) as hdul:
+            # rows of the flipped frame are taken from the end of the mapped data, only these are read
+            data = np.flip(hdul[0].data[n_rows - stop:n_rows - start]).astype(self.dtype)
+            bscale = hdul[0].header.get("BSCALE", 1)
+            bzero = hdul[0].header.get("BZERO", 0)
+
+        # scaling is done here, as scaled data (e.g. unsigned 16 bit) can not be mapped by astropy
+        if bscale != 1:
+            data *= self.dtype.type(bscale)
+        if bzero != 0:
+            data += self.dtype.type(bzero)
+
+        if self.master_dark is not None:
+            data -= self.master_dark[start:stop]
+        if self.master_flat is not None:
+            data /= self.master_flat[start:stop]
+
+        return data
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        return self.__read(i, 0, self.frame_shape[0])
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def rows(self, start: int, stop: int) -> np.ndarray:
+        """Rows start:stop of all frames as one stack"""
+        return np.array([self.__read(i, start, stop) for i in range(len(self))])
+
+    def load(self, out: Optional[np.ndarray] = None, progress: Optional[Callable[[int], None]] = None) -> np.ndarray:
+        """
+        Writes all frames into out, which may be a preallocated or disk-backed array (see util.allocate_stack)
+        A new in-memory array is created, if out is None
+        progress(n_done) is called after each frame
+        """
+        if out is None:
+            out = np.empty(self.shape, dtype=self.dtype)
+
+        for i, frame in enumerate(self):
+            out[i] = frame
+            if progress is not None:
+                progress(i + 1)
+
+        return out
@@ -0,0 +1,114 @@
+from PySide6.QtWidgets import QGraphicsObject, QStyleOptionGraphicsItem
+from PySide6.QtGui import QImage, QPainter
+from PySide6.QtCore import QRectF, QThreadPool, Signal
+
+import numpy as np
+
+import math
+from collections import OrderedDict
+from typing import Optional
+
+
+def downsample(image: np.ndarray) -> np.ndarray:
+    """Halves both dimensions by averaging blocks of 2x2 pixels, odd rows and columns are repeated"""
+    h, w = image.shape
+    if h % 2 or w % 2:
+        image = np.pad(image, ((0, h % 2), (0, w % 2)), mode="edge")
+
+    blocks = image.reshape(image.shape[0] // 2, 2, image.shape[1] // 2, 2).astype(np.uint32)
+    return ((blocks.sum(axis=(1, 3)) + 2) // 4).astype(image.dtype)
+
+
+class ImagePyramid(QGraphicsObject):
+    """
+    Grayscale image shown as tiles of a multi-resolution pyramid
+    Level k holds the image downsampled by 2 ** k. The levels are built in the background, until then finer levels are used.
+    Only tiles visible in the exposed rect are painted, from the level fitting the current zoom.
+    Tiles are QImages sharing the memory of contiguous copies of the numpy array, the most recently used are cached.
+    The image is either 8 bit or holds indices (e.g. 16 bit) into lut, which maps them to 8 bit grey values (see stretch.Stretch).
+    Changing the lut only drops the cached tiles, the pyramid is kept.
+    """
+
+    tile_size = 512  # pixels of one tile
+    max_tiles = 256  # tiles kept in the cache
+
+    # emitted (from a pool thread) with the list of levels once they are built
+    levels_built = Signal(list)
+
+    def __init__(self, image: np.ndarray, lut: Optional[np.ndarray] = None, parent=None):
+        super().__init__(parent)
+
+        self.levels = [np.ascontiguousarray(image if lut is not None else image.astype(np.uint8, copy=False))]
+        self.lut = lut
+        self.tiles = OrderedDict()  # (level, row, column) -> (buffer, QImage)
+
+        h, w = image.shape
+        self.__bounding_rect = QRectF(0, 0, w, h)
+
+        self.setFlag(QGraphicsObject.GraphicsItemFlag.ItemUsesExtendedStyleOption)
+
+        self.levels_built.connect(self.set_levels)
+        QThreadPool.globalInstance().start(self.build_levels)
+
+    def build_levels(self):
+        """Runs in a pool thread: downsamples until the whole image fits into one tile"""
+        levels = [self.levels[0]]
+        while max(levels[-1].shape) > self.tile_size:
+            levels.append(downsample(levels[-1]))
+        self.levels_built.emit(levels)
+
+    def set_levels(self, levels: list[np.ndarray]):
+        self.levels = levels
+        self.update()
+
+    def set_lut(self, lut: np.ndarray):
+        self.lut = lut
+        self.tiles.clear()
+        self.update()
+
+    def boundingRect(self) -> QRectF:
+        return self.__bounding_rect
+
+    def tile(self, level: int, row: int, column: int) -> QImage:
+        key = (level, row, column)
+
+        if key in self.tiles:
+            self.tiles.move_to_end(key)
+            return self.tiles[key][1]
+
+        t = self.tile_size
+        data = self.levels[level][row * t:(row + 1) * t, column * t:(column + 1) * t]
+        buffer = self.lut[data] if self.lut is not None else np.ascontiguousarray(data)
+        h, w = buffer.shape
+        # the QImage does not own the buffer, so both are kept together
+        image = QImage(buffer.data, w, h, w, QImage.Format.Format_Grayscale8)
+
+        self.tiles[key] = (buffer, image)
+        if len(self.tiles) > self.max_tiles:
+            self.tiles.popitem(last=False)
+
+        return image
+
+    def paint(self, painter: QPainter, option: QStyleOptionGraphicsItem, widget=None):
+        lod = option.levelOfDetailFromTransform(painter.worldTransform())
+
+        # coarsest level still having at least one image pixel per screen pixel
+        level = min(max(int(math.floor(math.log2(1 / lod))), 0) if lod > 0 else 0, len(self.levels) - 1)
+        scale = 2 ** level
+        h, w = self.levels[level].shape
+        t = self.tile_size
+
+        # coarse tiles may reach beyond the image by less than one of their pixels
+        painter.setClipRect(self.__bounding_rect)
+
+        exposed = option.exposedRect.intersected(self.__bounding_rect)
+        first_column = max(int(exposed.left() / scale) // t, 0)
+        last_column = min(int(math.ceil(exposed.right() / scale)) // t, (w - 1) // t)
+        first_row = max(int(exposed.top() / scale) // t, 0)
+        last_row = min(int(math.ceil(exposed.bottom() / scale)) // t, (h - 1) // t)
+
+        for row in range(first_row, last_row + 1):
+            for column in range(first_column, last_column + 1):
+                image = self.tile(level, row, column)
+                # tiles of coarse levels are scaled up to the full resolution coordinates of the scene
+                painter.drawImage(QRectF(column * t * scale, row * t * scale, image.width() * scale, image.height() * scale), image)
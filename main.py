@@ -6,7 +6,7 @@ from main_window import MainWindow
 # TODO input_cmd longitude/latitude not used
 
 if __name__ == "__main__":
-    print("Starting program, loading data, please wait...")
+    print("Starting program, data is loaded in the background...")
     app = QApplication()
 
     app.setStyleSheet("""
@@ -22,6 +22,7 @@ if __name__ == "__main__":
     """)
 
     window = MainWindow()
+
     window.showMaximized()
     window.show()
     exit(app.exec())
\ No newline at end of file
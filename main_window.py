@@ -1,36 +1,26 @@
-from PySide6.QtWidgets import QWidget, QHBoxLayout, QVBoxLayout, QPushButton, QGraphicsScene, QInputDialog, QMessageBox, QDoubleSpinBox, QLabel
-from PySide6.QtCore import QRect, QPoint, Slot
+from PySide6.QtWidgets import QWidget, QHBoxLayout, QVBoxLayout, QPushButton, QGraphicsScene, QInputDialog, QMessageBox, QDoubleSpinBox, QLabel, QProgressBar, QComboBox
+from PySide6.QtCore import QThread, QTimer, Slot
 import numpy as np
-from astropy.io import fits
-from photutils.aperture import CircularAperture, aperture_photometry
 
 import util
 
 import tomllib
-from pathlib import Path
+import zipfile
 from datetime import datetime
+from pathlib import Path
 
-from PIL import Image
-
-from star_ellipse import StarEllipse, StarStatus
+from executor import create_executor
+from master_cache import MasterCache
+from pipeline import Reduction
+from reduction_worker import ReductionWorker
+from image_pyramid import ImagePyramid
+from stretch import STRETCHES, Stretch
 from star_graphics_view import StarGraphicsView
 from plot_window import PlotWindow
 
 
 class MainWindow(QWidget):
-    # TODO: save selection and values
-    # TODO: dump log if wanted
-
-    @staticmethod
-    def shift_data(data, n_len, offset, pixel):
-        """Extracted from old script, as this code block was used multiple times"""
-        for i in range(n_len):
-            upper0 = abs(max(0, offset[i, 0]))
-            lower0 = abs(min(0, offset[i, 0]))
-            upper1 = abs(max(0, offset[i, 1]))
-            lower1 = abs(max(0, offset[i, 1]))
-            tmp = np.pad(data[i], ((upper0, lower0), (upper1, lower1)), mode='constant')
-            data[i] = tmp[lower0: pixel[0] + lower0, lower1:pixel[1] + lower1]
+    fhd_update_delay_ms = 150  # changes within this time are drawn together into open colour magnitude diagrams
 
     def __init__(self):
         """Setup Gui and calls self.setup()"""
@@ -43,6 +33,12 @@ class MainWindow(QWidget):
         with open("input_cmd.toml", "rb") as fl:
             self.input_cmd = tomllib.load(fl)
 
+        # calibration masters are reused between runs, if path_cache is set
+        self.master_cache = MasterCache(self.input_cmd.get("path_cache"), self.input_cmd.get("cache_size_mb", 2048))
+
+        # shared by the per-frame stages: statistics, alignment, detection and photometry
+        self.executor = create_executor(self.input_cmd.get("executor", "serial"), self.input_cmd.get("workers"))
+
         # Setup Graphics View
 
         self.scene = QGraphicsScene()
@@ -55,9 +51,27 @@ class MainWindow(QWidget):
 
         reddening_label = QLabel("Reddening")
         self.reddening_box = QDoubleSpinBox(value=0.0)
+        self.reddening_box.valueChanged.connect(self.schedule_fhd_update)
         button_stack.addWidget(reddening_label)
         button_stack.addWidget(self.reddening_box)
 
+        # display stretch of the star map, enabled once the master is stacked
+        stretch_label = QLabel("Stretch")
+        self.stretch_box = QComboBox()
+        self.stretch_box.addItems(STRETCHES)
+        self.stretch_box.setCurrentText(self.input_cmd.get("stretch", "log"))
+        self.stretch_box.currentTextChanged.connect(self.stretch_changed)
+        self.black_box = QDoubleSpinBox(decimals=1, prefix="Black ")
+        self.white_box = QDoubleSpinBox(decimals=1, prefix="White ")
+        self.black_box.valueChanged.connect(self.stretch_changed)
+        self.white_box.valueChanged.connect(self.stretch_changed)
+        button_stack.addWidget(stretch_label)
+        for widget in (self.stretch_box, self.black_box, self.white_box):
+            widget.setEnabled(False)
+            button_stack.addWidget(widget)
+        self.stretch = None
+        self.image_item = None
+
         button_offset_master = QPushButton("Masters Offset")
         button_offset_master.clicked.connect(self.button_offset_master_clicked)
         button_stack.addWidget(button_offset_master)
@@ -74,299 +88,301 @@ class MainWindow(QWidget):
         button_toggle_selection.clicked.connect(self.button_toggle_selection_clicked)
         button_stack.addWidget(button_toggle_selection)
 
+        button_select_all = QPushButton("Select All")
+        button_select_all.clicked.connect(self.button_select_all_clicked)
+        button_stack.addWidget(button_select_all)
+
         button_preview = QPushButton("FHD Diagram")
         button_preview.clicked.connect(self.button_preview_clicked)
         button_stack.addWidget(button_preview)
 
-        button_stack.addStretch()
+        button_save_session = QPushButton("Save Session")
+        button_save_session.clicked.connect(self.button_save_session_clicked)
+        button_stack.addWidget(button_save_session)
 
-        self.center = QHBoxLayout(self)
-        self.center.addWidget(self.graphics_view)
-        self.center.addLayout(button_stack)
+        # buttons working on results are enabled once the reduction is done
+        self.result_buttons = [button_offset_master, button_offset_short, button_offset_long, button_toggle_selection, button_select_all, button_preview,
+                               button_save_session]
+        for button in self.result_buttons:
+            button.setEnabled(False)
 
-        self.setup()
+        button_stack.addStretch()
 
-    def create_plot_window(self) -> PlotWindow:
-        plot_win = PlotWindow()
-        plot_win.closed.connect(self.plot_window_closed)
+        # progress of the reduction running in the background
+        self.status_label = QLabel("Starting reduction")
+        self.status_label.setWordWrap(True)
+        self.progress_bar = QProgressBar()
+        self.button_cancel = QPushButton("Cancel")
+        self.button_cancel.clicked.connect(self.button_cancel_clicked)
+        button_stack.addWidget(self.status_label)
+        button_stack.addWidget(self.progress_bar)
+        button_stack.addWidget(self.button_cancel)
 
-        self.plot_windows.add(plot_win)
-        return plot_win
+        # open colour magnitude diagrams follow selection, labels and reddening; bursts of changes are redrawn once
+        self.fhd_update_timer = QTimer(self, singleShot=True, interval=self.fhd_update_delay_ms)
+        self.fhd_update_timer.timeout.connect(self.update_fhd_plots)
 
-    def dark_correction(self, scidata: np.ndarray, n_short_light: int):
-        if lst := util.get_fits_names(self.input_cmd["path_dark_short"]):
-            frames = util.fits_to_array(lst)
-            scidata[:n_short_light] = util.dark_correction(scidata[:n_short_light], frames)
-        else:
-            QMessageBox.warning(self, "File not found", "Could not find files for short wave dark correction")
+        self.center = QHBoxLayout(self)
+        self.center.addWidget(self.graphics_view)
+        self.center.addLayout(button_stack)
 
-        if lst := util.get_fits_names(self.input_cmd["path_dark_long"]):
-            frames = util.fits_to_array(lst)
-            scidata[n_short_light:] = util.dark_correction(scidata[n_short_light:], frames)
-        else:
-            QMessageBox.warning(self, "File not found", "Could not find files for long wave dark correction")
-
-    def flat_fielding(self, scidata: np.ndarray, n_short_light: int):
-        # Define identity lambda if not dark correction can/should be used for flats
-        dark_correct_flats = lambda x: x
-
-        # Define dark_correct_flats otherwise
-        if self.input_cmd["do_dark_flat"]:
-            if lst := util.get_fits_names(self.input_cmd["path_dark_flat"]):
-                flat_darks = util.fits_to_array(lst)
-                dark_correct_flats = lambda x: util.dark_correction(x, flat_darks)
-            else:
-                QMessageBox.warning(self, "File not found", "Could not find files for dark correction of flats")
-
-        # Flatfielding starts here
-        if lst := util.get_fits_names(self.input_cmd["path_flat_short"]):
-            frames = dark_correct_flats(util.fits_to_array(lst))
-            scidata[:n_short_light] = util.flat_correction(scidata[:n_short_light], frames)
+        # a saved session is restored instead of reducing again
+        self.worker_thread = None
+        path_session = self.input_cmd.get("path_session")
+        if path_session is not None and Path(path_session).exists():
+            self.restore_session(path_session)
         else:
-            QMessageBox.warning(self, "File not found", "Could not find files for short wave flatfielding")
+            self.start_reduction()
 
-        if lst := util.get_fits_names(self.input_cmd["path_flat_long"]):
-            frames = dark_correct_flats(util.fits_to_array(lst))
-            scidata[n_short_light:] = util.flat_correction(scidata[n_short_light:], frames)
-        else:
-            QMessageBox.warning(self, "Files not found", "Could not find files for long wave flatfielding")
-
-    def master_wave(self, data: np.ndarray, n_light: int, pixel) -> tuple[np.ndarray, np.ndarray]:
-        if n_light > 1:
-            _, median, std = util.get_stats(data)
-            wave_offset = util.get_offset(data, median, std, 0)
-            self.shift_data(data, n_light, wave_offset, pixel)
-            master_wave = util.create_master(data)
-        else:
-            wave_offset = np.zeros((n_light, 2), dtype=int)
-            master_wave = data
+    def closeEvent(self, event):
+        if self.worker_thread is not None and self.worker_thread.isRunning():
+            # quit directly, the queued quit from worker.finished would need this (blocked) thread
+            self.worker.cancel()
+            self.worker_thread.quit()
+            self.worker_thread.wait()
+        self.executor.shutdown(cancel_futures=True)
+        if self.input_cmd.get("save_log", False):
+            self.save_log()
+        super().closeEvent(event)
 
-        return master_wave, wave_offset
+    def save_log(self) -> Path:
+        """Writes the log of this session to path_result"""
+        self.logger.append(f"Closed program @ {datetime.now().strftime('%Y-%m-%dT%H-%M-%S')}")
 
-    def setup(self):
-        self.n_stars_min = 1
+        save_file = Path(self.input_cmd["path_result"]) / f"log_{datetime.now().strftime('%Y-%m-%dT%H-%M-%S')}.txt"
+        save_file.parent.mkdir(parents=True, exist_ok=True)
+        save_file.write_text("\n".join(self.logger) + "\n")
 
-        fit_list = util.get_fits_names(self.input_cmd["path_light_short"])
-        short_wave_fit_list = fit_list
-        n_short_light = len(fit_list)
+        return save_file
 
-        if n_short_light == 0:
-            QMessageBox.warning(self, "File not found", f"Could not find short wave files at {self.input_cmd['path_light_short']}")
-            return
+    def create_plot_window(self) -> PlotWindow:
+        plot_win = PlotWindow()
+        plot_win.closed.connect(self.plot_window_closed)
 
-        long_wave_fit_list = util.get_fits_names(self.input_cmd["path_light_long"])
-        n_long_light = len(long_wave_fit_list)
-        fit_list.extend(long_wave_fit_list)
+        self.plot_windows.add(plot_win)
+        return plot_win
 
-        if n_long_light == 0:
-            QMessageBox.warning(self, "File not found", f"Could not find short wave files at {self.input_cmd['path_light_long']}")
+    def warn(self, title: str, text: str):
+        QMessageBox.warning(self, title, text)
+
+    def start_reduction(self):
+        """Runs the reduction on a worker thread, the scene is filled as results arrive"""
+        self.reduction = Reduction(self.input_cmd, self.executor, self.master_cache)
+
+        self.worker = ReductionWorker(self.reduction)
+        self.worker_thread = QThread(self)
+        self.worker.moveToThread(self.worker_thread)
+
+        self.worker_thread.started.connect(self.worker.run)
+        self.worker.progress.connect(self.reduction_progress)
+        self.worker.warning.connect(self.warn)
+        self.worker.stacked.connect(self.show_image)
+        self.worker.detected.connect(self.init_fhd)
+        self.worker.failed.connect(self.reduction_failed)
+        self.worker.cancelled.connect(self.reduction_cancelled)
+        self.worker.finished.connect(self.worker_thread.quit)
+        self.worker.finished.connect(self.button_cancel.hide)
+
+        self.worker_thread.start()
+
+    def restore_session(self, path_session: str):
+        """Fills the scene from a session file (see Reduction.save_session) without reducing"""
+        self.reduction = Reduction(self.input_cmd, self.executor, self.master_cache)
+        self.button_cancel.hide()
+
+        try:
+            self.reduction.load_session(path_session)
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile) as e:
+            QMessageBox.warning(self, "Session not restored", f"{e}\nReducing again")
+            self.button_cancel.show()
+            self.start_reduction()
             return
 
-        scidata = util.fits_to_array(fit_list)
-
-        pixel = scidata[0].shape
+        self.logger.append(f"Restored session {path_session}")
+        self.show_image(self.reduction.display_stretch())
+        self.init_fhd()
 
-        if self.input_cmd["do_dark"]:
-            self.dark_correction(scidata, n_short_light)
+    def session_path(self) -> Path:
+        """path_session, if set, else session.npz in path_result"""
+        return Path(self.input_cmd.get("path_session", Path(self.input_cmd["path_result"]) / "session.npz"))
 
-        if self.input_cmd["do_flat"]:
-            self.flat_fielding(scidata, n_short_light)
-
-        # here the master lights are created, after each picture was offset-aligned regarding your input
-        master_short_wave, self.short_wave_offset = self.master_wave(scidata[:n_short_light, :, :], n_short_light, pixel)
-        master_long_wave, self.long_wave_offset = self.master_wave(scidata[n_short_light:n_short_light + n_long_light, :, :], n_long_light, pixel)
-
-        # TODO no copying
-        scidata = np.zeros((2, pixel[0], pixel[1]))
-        scidata[0, :, :] = master_short_wave
-        scidata[1, :, :] = master_long_wave
-
-        del master_long_wave, master_short_wave
-
-        self.save_fits_files(scidata, n_short_light, n_long_light, short_wave_fit_list, long_wave_fit_list)
-
-        reference_fit = 0  # 0 = short wavelength; 1 = long wavelength
-        scidata_frame = scidata[reference_fit]
-
-        # subtract sky background and set negative values to 0
-        _, median, _ = util.get_stats(scidata_frame)
-        data2show = np.maximum(np.zeros(scidata_frame.shape), scidata_frame - median)
-
-        # equalize the histogram or use log scaling for nicer display of image
-        # array2show = np.uint16(aux.histeq(data2show,rescaled_pixel)/255)    # convert from 16 Bit to 8 Bit only for display
-        array2show = np.uint16(util.hist_log(data2show) / 255)  # convert from 16 Bit to 8 Bit only for display
-
-        image2show = Image.fromarray(array2show, mode='I;16')
-        self.scene.addPixmap(image2show.toqpixmap())
-
-        self.init_fhd(reference_fit, scidata, pixel)
-
-    def init_fhd(self, reference_fit, scidata, pixel):
-        """Initialize pictures and data"""
-
-        n_fits = len(scidata[:, 0, 0])
-        FWHM = self.input_cmd["FWHM"]
-        r_aperture = self.input_cmd["r_aperture"]
-        _, median, std = util.get_stats(scidata)
-        self.offset = util.get_offset(scidata, median, std, reference_fit)
-
-        # shift and pad the images; we want the original number of pixel -> only part of the padded array needed
-        self.shift_data(scidata, n_fits, self.offset, pixel)
-
-        # the stars of the images are found here and the positions are saved
-        _, self.n_stars_min, self.positions = util.detect_star(self.n_stars_min, scidata, median, std, FWHM, self.input_cmd["ratio"], self.input_cmd["threshold"])
-        stars_flux = np.zeros((n_fits, self.n_stars_min))
+    @Slot()
+    def button_save_session_clicked(self):
+        save_file = self.reduction.save_session(self.session_path())
+        self.logger.append(f"Saved session {save_file}")
+        QMessageBox.information(self, "Session saved", f"Session written to {save_file}")
+
+    @Slot(str, int, int)
+    def reduction_progress(self, stage: str, n_done: int, n_total: int):
+        self.status_label.setText(stage)
+        self.progress_bar.setMaximum(n_total)
+        self.progress_bar.setValue(n_done)
+
+    @Slot(str)
+    def reduction_failed(self, text: str):
+        self.status_label.setText("Reduction failed")
+        QMessageBox.critical(self, "Reduction failed", text)
 
-        # stars flux are only numbers, they are made from a circle around the position of a star and the sum of it.
-        for i in range(n_fits):
-            arr2d = [
-                [self.positions[i, a, 0], self.positions[i, a, 1]]
-                for a in range(len(self.positions[i, :, 0]))
-            ]
+    @Slot()
+    def reduction_cancelled(self):
+        self.status_label.setText("Reduction cancelled")
 
-            apertures = CircularAperture(arr2d, r=r_aperture * FWHM)  # the area, where the flux is going to be taken from
-            phot = aperture_photometry(scidata[i, :, :] - median[i], apertures)  # the numbers are generated from the specific area of 'apertures'
-            stars_flux[i, :] = phot['aperture_sum'][0:self.n_stars_min]  # numbers, that represent the luminosity of a star. Not real flux, but similar
+    @Slot()
+    def button_cancel_clicked(self):
+        self.status_label.setText("Cancelling")
+        self.worker.cancel()
+
+    @Slot(object)
+    def show_image(self, stretch: Stretch):
+        """Shows the stacked master while stars are still detected"""
+        self.stretch = stretch
+
+        # data range of the master for black and white point
+        for box in (self.black_box, self.white_box):
+            box.blockSignals(True)
+            box.setRange(stretch.low, stretch.high)
+        self.black_box.setValue(stretch.default_points()[0])
+        self.white_box.setValue(stretch.default_points()[1])
+        for box in (self.black_box, self.white_box):
+            box.blockSignals(False)
+            box.setEnabled(True)
+        self.stretch_box.setEnabled(True)
+
+        self.image_item = ImagePyramid(stretch.quantized, self.current_lut())
+        self.scene.addItem(self.image_item)
+
+    def current_lut(self) -> np.ndarray:
+        kind = self.stretch_box.currentText()
+
+        if kind == "zscale":
+            # show the limits used by zscale
+            for box, value in zip((self.black_box, self.white_box), self.stretch.zscale_limits):
+                box.blockSignals(True)
+                box.setValue(value)
+                box.blockSignals(False)
+
+        return self.stretch.lut(kind, self.black_box.value(), self.white_box.value())
 
-        # creating the ovals around the stars for user input
-        for j in range(self.n_stars_min):
-            e = StarEllipse(
-                QRect(
-                    QPoint(self.positions[reference_fit, j, 0] - 3 / 2 * r_aperture * FWHM,
-                           self.positions[reference_fit, j, 1] - 3 / 2 * r_aperture * FWHM,),
-                    QPoint(self.positions[reference_fit, j, 0] + 3 / 2 * r_aperture * FWHM,
-                           self.positions[reference_fit, j, 1] + 3 / 2 * r_aperture * FWHM,)
-                ),
-            )
-            e.index = j
-            e.flux1 = stars_flux[0, j]
-            e.flux2 = stars_flux[1, j]
+    @Slot()
+    def stretch_changed(self):
+        """Only the lookup table of the shown image changes, visible tiles are redrawn"""
+        if self.image_item is not None:
+            self.image_item.set_lut(self.current_lut())
 
-            self.scene.addItem(e)
+    @Slot()
+    def init_fhd(self):
+        """Adds the markers around the detected stars, all drawn by one overlay item"""
+        # clicks within the ellipse around a star hit it
+        marker_radius = 3 / 2 * self.input_cmd["r_aperture"] * self.input_cmd["FWHM"]
+        self.graphics_view.set_stars(self.reduction.catalogue, self.reduction.positions[self.reduction.reference_fit], marker_radius,
+                                     (self.input_cmd['short_colour'], self.input_cmd['long_colour']))
+        self.reduction_finished()
+
+    def reduction_finished(self):
+        self.reduction.catalogue.subscribe(self.schedule_fhd_update)
+
+        for button in self.result_buttons:
+            button.setEnabled(True)
+
+        status = f"Found {self.reduction.n_stars_min} stars\n{self.master_cache.summary()}"
+        if (peak := util.peak_rss_mb()) is not None:
+            status += f"\nPeak memory {peak:.0f} MB"
+        self.status_label.setText(status)
+
+        self.logger.append(self.master_cache.summary())
+        if self.reduction.report.stages:
+            self.logger.append(self.reduction.report.summary())
+        if peak is not None:
+            self.logger.append(f"Peak memory {peak:.0f} MB")
 
         self.logger.append(f"""
-        Found {self.n_stars_min} Stars
+        Found {self.reduction.n_stars_min} Stars
         Select the not included stars by left clicking and put in the magnitude via right clicking and then typing in the console. Leave blank for no input
         The colours mean: green - in the cluster ; red - not in the cluster ; blue - magnitude has been typed in ; orange - magnitude is given, but not in the cluster
         Controls are: Left click - deselect ; right click - type in magnitude
         """)
 
-    def save_fits_files(self, scidata, n_short_light, n_long_light, short_wave_FIT_list, long_wave_FIT_list):
-        path_save = Path(self.input_cmd["path_result"])
-
-        if not path_save.exists():
-            path_save.mkdir(parents=True)
-
-        timestamp = datetime.now()
-
-        hdulist_short = fits.HDUList(fits.PrimaryHDU(data=scidata[0, :, :]))
-        with fits.open(short_wave_FIT_list[0]) as hdul:
-            hdulist_short[0].header = hdul[0].header
-
-        hdulist_short[0].header['BZERO'] = 0.0
-        hdulist_short[0].header['SNAPSHOT'] = n_short_light
-        hdulist_short[0].header['Date'] = timestamp.strftime("%Y-%m-%d")
-        hdulist_short[0].header['Note'] = 'Created by colour_magnitude_diagram.py'
-
-        hdulist_long = fits.HDUList(fits.PrimaryHDU(data=scidata[1, :, :]))
-        with fits.open(long_wave_FIT_list[0]) as hdul:
-            hdulist_long[0].header = hdul[0].header
-
-        hdulist_long[0].header['BZERO'] = 0.0
-        hdulist_long[0].header['SNAPSHOT'] = n_long_light
-        hdulist_long[0].header['Date'] = timestamp.strftime("%Y-%m-%d")
-        hdulist_long[0].header['Note'] = 'Created by colour_magnitude_diagram.py'
-
-        tme = timestamp.strftime("%Y-%m-%dT%H-%M-%S")
-
-        hdulist_short.writeto(path_save / f"{self.input_cmd['short_colour']}_{tme}.fits", overwrite=True)
-        hdulist_long.writeto(path_save / f"{self.input_cmd['long_colour']}_{tme}.fits", overwrite=True)
-
     @Slot()
     def button_offset_master_clicked(self):
         plot_win = self.create_plot_window()
-        plot_win.plot_offset(self.offset)
+        plot_win.plot_offset(self.reduction.offset)
         plot_win.show()
 
     @Slot()
     def button_offset_short_clicked(self):
         plot_win = self.create_plot_window()
-        plot_win.plot_offset(self.short_wave_offset)
+        plot_win.plot_offset(self.reduction.short_wave_offset)
         plot_win.show()
 
     @Slot()
     def button_offset_long_clicked(self):
         plot_win = self.create_plot_window()
-        plot_win.plot_offset(self.long_wave_offset)
+        plot_win.plot_offset(self.reduction.long_wave_offset)
         plot_win.show()
 
     @Slot()
     def button_toggle_selection_clicked(self):
         """Toggles selection of ALL Stars"""
-        for star in self.graphics_view.stars():
-            star.status ^= StarStatus.Selected
+        self.reduction.catalogue.toggle_selection()
+        self.graphics_view.update_pens()
+
+    @Slot()
+    def button_select_all_clicked(self):
+        self.graphics_view.select_all()
 
     @Slot()
     def button_preview_clicked(self):
         plot_win = self.create_plot_window()
         plot_win.saving.connect(self.save_fhd_files)
 
-        plot_win.plot_fhd(self.n_stars_min, list(self.graphics_view.stars()), self.input_cmd, self.reddening_box.value())
+        plot_win.plot_fhd(self.reduction.calibration, self.input_cmd, self.reddening_box.value(), self.input_cmd.get("cmd_density", False))
+        self.logger.append(self.reduction.calibration.summary((self.input_cmd['short_colour'], self.input_cmd['long_colour'])))
         plot_win.show()
 
-    @Slot(StarEllipse)
-    def info_star(self, star: StarEllipse):
+    @Slot(int)
+    def info_star(self, index: int):
         """Set values of one star"""
 
         # Ask for both values
+        mag_short, mag_long = self.reduction.catalogue.user_mag[:, index]
 
-        typed_mag_1, ok = QInputDialog.getDouble(self, "Input short colour", f"Input {self.input_cmd['short_colour']}", value=star.vmag1, decimals=3)
+        typed_mag_1, ok = QInputDialog.getDouble(self, "Input short colour", f"Input {self.input_cmd['short_colour']}", value=mag_short, decimals=3)
         if not ok:
             QMessageBox.warning(self, "Aborting", "Expected valid floating point number")
             return
 
-        typed_mag_2, ok = QInputDialog.getDouble(self, "Input long colour", f"Input {self.input_cmd['long_colour']}", value=star.vmag2, decimals=3)
+        typed_mag_2, ok = QInputDialog.getDouble(self, "Input long colour", f"Input {self.input_cmd['long_colour']}", value=mag_long, decimals=3)
         if not ok:
             QMessageBox.warning(self, "Aborting", "Expected valid floating point number")
             return
 
-        # Update star
-        star.vmag1 = typed_mag_1
-        star.vmag2 = typed_mag_2
-
-        # Change status: Colour etc. will be adjusted automatically
+        # Update star, status is changed by the catalogue (unset if both values are 0); the overlay shows the values on hover
+        self.reduction.catalogue.set_user_mag(index, typed_mag_1, typed_mag_2)
+        self.graphics_view.update_pens()
 
-        # Unset star if both values are 0
         if typed_mag_1 == 0.0 and typed_mag_2 == 0.0:
-            self.logger.append(f"Unset {star.index}")
-            star.status &= ~StarStatus.Labeled
-            star.setToolTip("")
+            self.logger.append(f"Unset {index}")
         else:
-            self.logger.append(f"Set {star.index} to {typed_mag_1} and {typed_mag_2}")
-            star.status |= StarStatus.Labeled
-            star.setToolTip(f"{self.input_cmd['short_colour']}: {typed_mag_1} | {self.input_cmd['long_colour']}: {typed_mag_2}")
+            self.logger.append(f"Set {index} to {typed_mag_1} and {typed_mag_2}")
 
     @Slot(np.ndarray, np.ndarray)
     def save_fhd_files(self, mag_short: np.ndarray, mag_long: np.ndarray):
         """Called from PlotWindow to save fhd data"""
 
-        swc = self.input_cmd["short_colour"]
-        lwc = self.input_cmd["long_colour"]
+        selected = np.flatnonzero(self.reduction.catalogue.selected)
+        save_files = self.reduction.save_fhd_file(mag_short, mag_long, selected)
 
-        save_file = Path(self.input_cmd["path_result"]) / f"colour_mag_diagram_{swc}-{lwc}_{datetime.now().strftime('%Y-%m-%dT%H-%M-%S')}.dat"
-        if not save_file.exists():
-            save_file.parent.mkdir(parents=True, exist_ok=True)
+        QMessageBox.information(self, "Data saved", "Data written to\n" + "\n".join(str(f) for f in save_files))
 
-        with save_file.open("w+") as fl:
-            fl.write(f"#ID\tx[px]\ty[px]\tflux_{swc}[ADU]\tflux_{lwc}[ADU]\t{swc}_mag\t{lwc}_mag\n")
-            lines = [
-                f"{star.index}\t{self.positions[0,star.index,0]}\t{self.positions[0,star.index,1]}\t"
-                f"{star.flux1}\t{star.flux2}\t"
-                f"{mag_short[star.index]}\t{mag_long[star.index]}\n"
-                for star in filter(lambda x: StarStatus.Selected in x.status, self.graphics_view.stars())]
-            fl.writelines(lines)
+    def schedule_fhd_update(self, *args):
+        """Called on every change of stars or reddening, (re)starts the timer for redrawing the diagrams"""
+        self.fhd_update_timer.start()
 
-        QMessageBox.information(self, "Data saved", f"Data written to {save_file}")
+    @Slot()
+    def update_fhd_plots(self):
+        for plot_win in self.plot_windows:
+            if plot_win.calibration is not None:
+                plot_win.update_fhd(self.reddening_box.value())
 
     @Slot(QWidget)
     def plot_window_closed(self, win: QWidget):
@@ -0,0 +1,112 @@
+import numpy as np
+
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import Callable, Optional
+
+
+class MasterCache:
+    """
+    On-disk cache for calibration masters (darks, flats)
+    Masters are stored as .npy in path_cache, keyed on paths, sizes and modification times of the input files
+    and on the way they are combined. Hits are loaded memory-mapped.
+    If the cache grows beyond max_size_mb, the least recently used masters are removed.
+    With path_cache None, every master is built and nothing is stored.
+    """
+
+    def __init__(self, path_cache: Optional[Path | str] = None, max_size_mb: float = 2048):
+        self.path_cache = Path(path_cache) if path_cache is not None else None
+        self.max_size = max_size_mb * 2 ** 20
+
+        self.hits = 0
+        self.misses = 0
+
+        if self.path_cache is not None:
+            self.path_cache.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(fit_list: list[Path], method: str = "median", depends_on: str = "", dtype=np.float32) -> str:
+        """
+        Fingerprint of the input files, the combine method and the dtype of the master
+        depends_on: key of another master used to build this one (e.g. dark for flats)
+        """
+        fingerprint = hashlib.sha256(f"{method}|{depends_on}|{np.dtype(dtype).name}".encode())
+
+        for fit_name in sorted(Path(f).resolve() for f in fit_list):
+            stat = fit_name.stat()
+            fingerprint.update(f"|{fit_name}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+
+        return fingerprint.hexdigest()
+
+    def get(self, key: str, build: Callable[[], np.ndarray]) -> np.ndarray:
+        """
+        Returns the master stored for key, build() creates and stores it on a miss
+        Safe for several processes sharing path_cache: each writer uses its own temporary file,
+        a master stored by another process in the meantime is used instead of the own one
+        """
+        if self.path_cache is None:
+            self.misses += 1
+            return build()
+
+        file_name = self.path_cache / f"{key}.npy"
+
+        if (master := self.load(file_name)) is not None:
+            self.hits += 1
+            return master
+
+        master = build()
+
+        # another process stored the master while it was built here
+        if (stored := self.load(file_name)) is not None:
+            self.hits += 1
+            return stored
+
+        self.misses += 1
+
+        # write to a temporary file of this process first, so no partial master is found by other runs
+        with tempfile.NamedTemporaryFile(dir=self.path_cache, suffix=".tmp", delete=False) as fl:
+            try:
+                np.save(fl, master)
+            except BaseException:
+                fl.close()
+                os.unlink(fl.name)
+                raise
+        os.replace(fl.name, file_name)
+
+        self.evict()
+
+        return master
+
+    @staticmethod
+    def load(file_name: Path) -> Optional[np.ndarray]:
+        """Master stored in file_name (memory-mapped), None if missing or removed meanwhile by another process"""
+        try:
+            # touch file to mark it as recently used
+            os.utime(file_name)
+            return np.load(file_name, mmap_mode="r")
+        except FileNotFoundError:
+            return None
+
+    def evict(self):
+        """Removes least recently used masters until the cache fits into max_size"""
+        files = []
+        for fl in self.path_cache.glob("*.npy"):
+            try:
+                files.append((fl.stat(), fl))
+            except FileNotFoundError:
+                continue
+
+        files.sort(key=lambda x: x[0].st_mtime)
+        size = sum(stat.st_size for stat, _ in files)
+
+        # the most recent master is always kept
+        for stat, fl in files[:-1]:
+            if size <= self.max_size:
+                break
+            size -= stat.st_size
+            fl.unlink(missing_ok=True)
+
+    def summary(self) -> str:
+        return f"Master cache: {self.hits} hits, {self.misses} misses"
@@ -0,0 +1,370 @@
+import numpy as np
+from astropy.io import fits
+
+import util
+import catalogue_export
+from executor import create_executor, n_workers
+from frame_source import FrameSource
+from master_cache import MasterCache
+from run_report import RunReport
+from calibration import MagnitudeCalibration
+from star_catalogue import StarCatalogue
+from stretch import Stretch
+
+import os
+import sys
+from concurrent.futures import Executor
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Optional
+
+
+def print_warning(title: str, text: str):
+    print(f"{title}: {text}", file=sys.stderr)
+
+
+class ReductionCancelled(Exception):
+    """Raised inside a running Reduction after cancel() was called"""
+
+
+class Reduction:
+    """
+    Reduction of one field as configured by input_cmd: load, calibrate, align, stack, detect and photometer
+    Does not depend on Qt, so it is used by MainWindow as well as by the headless batch.py
+    Warnings (e.g. missing calibration files) are passed to warn(title, text),
+    progress(stage, n_done, n_total) is called per frame (per block of rows while stacking)
+    Every stage is measured in report (see RunReport), which run() writes to path_result
+    """
+
+    reference_fit = 0  # 0 = short wavelength; 1 = long wavelength
+
+    # results stored in session files, see save_session
+    session_version = 2
+    session_arrays = ("scidata", "short_wave_offset", "long_wave_offset", "offset", "median", "std", "positions",
+                      "stars_flux", "stars_flux_err", "stars_sky")
+
+    photometry_chunk = 2048  # stars measured at once (in all frames)
+
+    def __init__(self, input_cmd: dict, executor: Optional[Executor] = None, master_cache: Optional[MasterCache] = None,
+                 warn: Callable[[str, str], None] = print_warning, progress: Optional[Callable[[str, int, int], None]] = None):
+        self.input_cmd = input_cmd
+        self.executor = executor if executor is not None else create_executor(input_cmd.get("executor", "serial"), input_cmd.get("workers"))
+        self.master_cache = master_cache if master_cache is not None else MasterCache(input_cmd.get("path_cache"), input_cmd.get("cache_size_mb", 2048))
+        self.warn = warn
+        self.progress = progress
+        self.__cancelled = False
+        self.rows_per_tile = input_cmd.get("rows_per_tile", 256)
+
+        # working dtype of frames, masters and stacks; float32 holds 16 bit data exactly
+        self.dtype = np.dtype(input_cmd.get("dtype", "float32"))
+        self.report = RunReport(input_cmd.get("trace_memory", False), input_cmd.get("profile_stage"))
+
+        self.short_wave_fit_list = []
+        self.long_wave_fit_list = []
+        self.pixel = None
+
+        # stack of calibrated lights (short wave first), master lights (short, long) and their offsets
+        self.lights = None
+        self.scidata = None
+        self.short_wave_offset = None
+        self.long_wave_offset = None
+        self.offset = None
+
+        # detection and photometry on the master lights
+        self.median = None
+        self.std = None
+        self.n_stars_min = 1
+        self.positions = None
+        self.stars_flux = None
+        self.stars_flux_err = None
+        self.stars_sky = None
+        self.catalogue = None
+        self.calibration = None
+
+    def cancel(self):
+        """Stops the reduction at the next frame, the running stage raises ReductionCancelled"""
+        self.__cancelled = True
+
+    def reporter(self, stage: str, n_total: int) -> Callable[[int], None]:
+        """Progress callback for the frames of one stage, raises ReductionCancelled if cancel() was called"""
+        def report(n_done: int):
+            if self.__cancelled:
+                raise ReductionCancelled()
+            if self.progress is not None:
+                self.progress(stage, n_done, n_total)
+
+        report(0)
+        return report
+
+    @property
+    def n_short_light(self) -> int:
+        return len(self.short_wave_fit_list)
+
+    @property
+    def n_long_light(self) -> int:
+        return len(self.long_wave_fit_list)
+
+    def master_darks(self) -> tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+        """Master darks for short and long wave lights, None if files are missing"""
+        master_short = master_long = None
+
+        if lst := util.get_fits_names(self.input_cmd["path_dark_short"]):
+            master_short = self.master_cache.get(MasterCache.key(lst, dtype=self.dtype), lambda: util.create_master(FrameSource(lst, dtype=self.dtype), rows_per_tile=self.rows_per_tile))
+        else:
+            self.warn("File not found", "Could not find files for short wave dark correction")
+
+        if lst := util.get_fits_names(self.input_cmd["path_dark_long"]):
+            master_long = self.master_cache.get(MasterCache.key(lst, dtype=self.dtype), lambda: util.create_master(FrameSource(lst, dtype=self.dtype), rows_per_tile=self.rows_per_tile))
+        else:
+            self.warn("File not found", "Could not find files for long wave dark correction")
+
+        return master_short, master_long
+
+    def master_flats(self) -> tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+        """Normalized master flats for short and long wave lights, None if files are missing"""
+        master_short = master_long = None
+
+        # flats are dark corrected on reading, if a master dark for the flats is available
+        flat_dark = None
+        flat_dark_key = ""
+
+        if self.input_cmd["do_dark_flat"]:
+            if lst := util.get_fits_names(self.input_cmd["path_dark_flat"]):
+                flat_dark_key = MasterCache.key(lst, dtype=self.dtype)
+                flat_dark = self.master_cache.get(flat_dark_key, lambda: util.create_master(FrameSource(lst, dtype=self.dtype), rows_per_tile=self.rows_per_tile))
+            else:
+                self.warn("File not found", "Could not find files for dark correction of flats")
+
+        # Flatfielding starts here
+        if lst := util.get_fits_names(self.input_cmd["path_flat_short"]):
+            master_short = self.master_cache.get(MasterCache.key(lst, "flat", flat_dark_key, self.dtype),
+                                                 lambda: util.master_flat(FrameSource(lst, master_dark=flat_dark, dtype=self.dtype), rows_per_tile=self.rows_per_tile))
+        else:
+            self.warn("File not found", "Could not find files for short wave flatfielding")
+
+        if lst := util.get_fits_names(self.input_cmd["path_flat_long"]):
+            master_long = self.master_cache.get(MasterCache.key(lst, "flat", flat_dark_key, self.dtype),
+                                                lambda: util.master_flat(FrameSource(lst, master_dark=flat_dark, dtype=self.dtype), rows_per_tile=self.rows_per_tile))
+        else:
+            self.warn("Files not found", "Could not find files for long wave flatfielding")
+
+        return master_short, master_long
+
+    def load(self) -> bool:
+        """Reads and calibrates the lights, returns False if no lights were found"""
+        self.short_wave_fit_list = util.get_fits_names(self.input_cmd["path_light_short"])
+
+        if self.n_short_light == 0:
+            self.warn("File not found", f"Could not find short wave files at {self.input_cmd['path_light_short']}")
+            return False
+
+        self.long_wave_fit_list = util.get_fits_names(self.input_cmd["path_light_long"])
+
+        if self.n_long_light == 0:
+            self.warn("File not found", f"Could not find long wave files at {self.input_cmd['path_light_long']}")
+            return False
+
+        dark_short = dark_long = flat_short = flat_long = None
+
+        if self.input_cmd["do_dark"]:
+            with self.report.stage("Dark"):
+                dark_short, dark_long = self.master_darks()
+
+        if self.input_cmd["do_flat"]:
+            with self.report.stage("Flat"):
+                flat_short, flat_long = self.master_flats()
+
+        short_wave_source = FrameSource(self.short_wave_fit_list, dark_short, flat_short, self.dtype)
+        long_wave_source = FrameSource(self.long_wave_fit_list, dark_long, flat_long, self.dtype)
+        self.pixel = short_wave_source.frame_shape
+
+        # frames are read and calibrated one by one into the (optionally disk-backed) stack
+        with self.report.stage("Load", n_frames=self.n_short_light + self.n_long_light):
+            self.lights = util.allocate_stack((self.n_short_light + self.n_long_light, *self.pixel), self.input_cmd.get("path_scratch"), self.dtype)
+            short_wave_source.load(self.lights[:self.n_short_light], self.reporter("Loading short wave", self.n_short_light))
+            long_wave_source.load(self.lights[self.n_short_light:], self.reporter("Loading long wave", self.n_long_light))
+
+        return True
+
+    def master_wave(self, data: np.ndarray, colour: str) -> tuple[np.ndarray, np.ndarray]:
+        """Aligns the frames of one colour and combines them to the master light"""
+        n_light = len(data)
+
+        if n_light > 1:
+            with self.report.stage(f"Statistics {colour}", n_frames=n_light):
+                _, median, std = util.get_stats(data, self.executor, self.reporter(f"Statistics {colour}", n_light),
+                                                self.input_cmd.get("stats_max_pixels"), self.input_cmd.get("stats_sampling", "stride"))
+            with self.report.stage(f"Alignment {colour}", n_frames=n_light):
+                wave_offset = util.get_offset(data, median, std, 0, self.executor, self.reporter(f"Aligning {colour}", n_light),
+                                              self.input_cmd.get("align_downsample", 1), self.input_cmd.get("subpixel_alignment", False))
+                util.shift_data(data, wave_offset)
+            with self.report.stage(f"Stacking {colour}", n_frames=n_light):
+                master_wave = util.create_master(data, rows_per_tile=self.rows_per_tile, progress=self.reporter(f"Stacking {colour}", self.pixel[0]))
+        else:
+            wave_offset = np.zeros((n_light, 2), dtype=int)
+            master_wave = data[0]
+
+        return master_wave, wave_offset
+
+    def stack(self):
+        """Creates the master lights, after each picture was offset-aligned"""
+        self.scidata = np.zeros((2, *self.pixel), dtype=self.dtype)
+
+        self.scidata[0], self.short_wave_offset = self.master_wave(self.lights[:self.n_short_light], self.input_cmd["short_colour"])
+        self.scidata[1], self.long_wave_offset = self.master_wave(self.lights[self.n_short_light:], self.input_cmd["long_colour"])
+
+        # the single lights are not needed anymore
+        self.lights = None
+
+        # computed once, used by the display, the alignment of the masters, detection and photometry
+        n_fits = len(self.scidata)
+        with self.report.stage("Statistics masters", n_frames=n_fits):
+            _, self.median, self.std = util.get_stats(self.scidata, self.executor, self.reporter("Statistics masters", n_fits),
+                                                      self.input_cmd.get("stats_max_pixels"), self.input_cmd.get("stats_sampling", "stride"))
+
+    def display_stretch(self) -> Stretch:
+        """Stretch of the reference master, black point at its sky background from the statistics of stack"""
+        return Stretch(self.scidata[self.reference_fit], self.median[self.reference_fit])
+
+    def detect(self):
+        """Aligns the master lights, finds the stars and measures their flux"""
+        n_fits = len(self.scidata)
+        FWHM = self.input_cmd["FWHM"]
+
+        with self.report.stage("Alignment masters", n_frames=n_fits):
+            self.offset = util.get_offset(self.scidata, self.median, self.std, self.reference_fit, self.executor, self.reporter("Aligning masters", n_fits),
+                                          self.input_cmd.get("align_downsample", 1), self.input_cmd.get("subpixel_alignment", False))
+
+            # shift and pad the images; we want the original number of pixel -> only part of the padded array needed
+            util.shift_data(self.scidata, self.offset)
+
+        # the stars of the images are found here and the positions are saved
+        with self.report.stage("Detection", n_frames=n_fits) as record:
+            _, self.n_stars_min, self.positions = util.detect_star(self.n_stars_min, self.scidata, self.median, self.std, FWHM,
+                                                                   self.input_cmd["ratio"], self.input_cmd["threshold"], self.executor,
+                                                                   self.reporter("Detecting stars", n_fits))
+            record["n_stars"] = self.n_stars_min
+
+        # sum in a circle around the position of a star, minus the sky of the whole frame or of an annulus around the star
+        annulus = self.input_cmd.get("sky_annulus")
+        if annulus is not None:
+            annulus = (annulus[0] * FWHM, annulus[1] * FWHM)
+        n_chunks = -(-self.positions.shape[1] // self.photometry_chunk)
+        with self.report.stage("Photometry", n_frames=n_fits, n_stars=self.n_stars_min):
+            self.stars_flux, self.stars_flux_err, self.stars_sky = util.photometry(
+                self.scidata, self.median, self.std, self.positions, self.input_cmd["r_aperture"] * FWHM, annulus, self.input_cmd.get("gain", 1.),
+                self.executor, self.reporter("Photometry", n_chunks), self.photometry_chunk, 2 * n_workers(self.executor))
+
+        self.init_catalogue()
+
+    def init_catalogue(self):
+        self.catalogue = StarCatalogue(self.positions, self.stars_flux)
+        self.calibration = MagnitudeCalibration(self.catalogue, self.input_cmd.get("robust_calibration", False),
+                                                self.input_cmd.get("calibration_sigma", 3.))
+
+    def run(self) -> bool:
+        """All stages of the reduction, returns False if no lights were found"""
+        if not self.load():
+            return False
+
+        self.stack()
+        self.save_fits_files()
+        self.detect()
+        self.write_report()
+
+        return True
+
+    def write_report(self) -> list[Path]:
+        """Writes the run report (see RunReport) to path_result, unless run_report is false"""
+        if not self.input_cmd.get("run_report", True):
+            return []
+        return self.report.write(self.input_cmd["path_result"], self.input_cmd)
+
+    def save_fits_files(self):
+        with self.report.stage("Writing masters", n_frames=len(self.scidata)):
+            self.__save_fits_files()
+
+    def __save_fits_files(self):
+        path_save = Path(self.input_cmd["path_result"])
+
+        if not path_save.exists():
+            path_save.mkdir(parents=True)
+
+        timestamp = datetime.now()
+
+        hdulist_short = fits.HDUList(fits.PrimaryHDU(data=self.scidata[0, :, :]))
+        with fits.open(self.short_wave_fit_list[0]) as hdul:
+            hdulist_short[0].header = hdul[0].header
+
+        hdulist_short[0].header['BZERO'] = 0.0
+        hdulist_short[0].header['SNAPSHOT'] = self.n_short_light
+        hdulist_short[0].header['Date'] = timestamp.strftime("%Y-%m-%d")
+        hdulist_short[0].header['Note'] = 'Created by colour_magnitude_diagram.py'
+
+        hdulist_long = fits.HDUList(fits.PrimaryHDU(data=self.scidata[1, :, :]))
+        with fits.open(self.long_wave_fit_list[0]) as hdul:
+            hdulist_long[0].header = hdul[0].header
+
+        hdulist_long[0].header['BZERO'] = 0.0
+        hdulist_long[0].header['SNAPSHOT'] = self.n_long_light
+        hdulist_long[0].header['Date'] = timestamp.strftime("%Y-%m-%d")
+        hdulist_long[0].header['Note'] = 'Created by colour_magnitude_diagram.py'
+
+        tme = timestamp.strftime("%Y-%m-%dT%H-%M-%S")
+
+        hdulist_short.writeto(path_save / f"{self.input_cmd['short_colour']}_{tme}.fits", overwrite=True)
+        hdulist_long.writeto(path_save / f"{self.input_cmd['long_colour']}_{tme}.fits", overwrite=True)
+
+    def save_session(self, path_session: Path | str) -> Path:
+        """
+        Writes masters, offsets, detected stars, their flux and the state of the catalogue (status, user defined magnitudes)
+        as uncompressed .npz, so load_session restores them without reducing again
+        """
+        path_session = Path(path_session)
+        path_session.parent.mkdir(parents=True, exist_ok=True)
+
+        arrays = {name: getattr(self, name) for name in self.session_arrays}
+
+        # write to temporary file first, an interrupted save does not destroy the last session
+        tmp_name = path_session.with_suffix(".tmp")
+        with tmp_name.open("wb") as fl:
+            np.savez(fl, version=self.session_version, n_stars_min=self.n_stars_min,
+                     short_wave_fit_list=np.array([str(f) for f in self.short_wave_fit_list]),
+                     long_wave_fit_list=np.array([str(f) for f in self.long_wave_fit_list]),
+                     status=self.catalogue.status, user_mag=self.catalogue.user_mag, **arrays)
+        os.replace(tmp_name, path_session)
+
+        return path_session
+
+    def load_session(self, path_session: Path | str):
+        """Restores a session written by save_session, replacing load, stack and detect"""
+        with np.load(path_session) as session:
+            if session["version"] != self.session_version:
+                raise ValueError(f"{path_session}: session version {session['version']} is not supported")
+
+            for name in self.session_arrays:
+                setattr(self, name, session[name])
+
+            self.n_stars_min = int(session["n_stars_min"])
+            self.short_wave_fit_list = [Path(f) for f in session["short_wave_fit_list"]]
+            self.long_wave_fit_list = [Path(f) for f in session["long_wave_fit_list"]]
+
+            self.init_catalogue()
+            self.catalogue.status[:] = session["status"]
+            self.catalogue.user_mag[:] = session["user_mag"]
+
+    def save_fhd_file(self, mag_short: np.ndarray, mag_long: np.ndarray, selected: Optional[np.ndarray] = None,
+                      formats: Optional[list[str]] = None) -> list[Path]:
+        """
+        Writes the colour magnitude table of the selected stars (all if selected is None) in every format
+        (default: export_formats, see catalogue_export.FORMATS), returns the written files
+        """
+        swc = self.input_cmd["short_colour"]
+        lwc = self.input_cmd["long_colour"]
+        formats = formats if formats is not None else self.input_cmd.get("export_formats", ["dat"])
+
+        save_file = Path(self.input_cmd["path_result"]) / f"colour_mag_diagram_{swc}-{lwc}_{datetime.now().strftime('%Y-%m-%dT%H-%M-%S')}"
+        columns = catalogue_export.catalogue_columns(self, mag_short, mag_long, selected)
+
+        return catalogue_export.write_catalogue(save_file, columns, catalogue_export.catalogue_meta(self), formats,
+                                                self.input_cmd.get("dat_extended", False))
@@ -5,10 +5,14 @@ from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg
 
 import numpy as np
 
-from star_ellipse import StarEllipse, StarStatus
+from typing import Optional
+
+from calibration import MagnitudeCalibration
 
 
 class PlotWindow(QWidget):
+    hexbin_gridsize = 50  # hexagons in x direction of the density map
+
     # Signal is emitted when the window is closed. Used to remove it from the MainWindow list
     closed = Signal(QWidget)
 
@@ -25,17 +29,27 @@ class PlotWindow(QWidget):
         self.mag_short = None
         self.mag_long = None
 
-        button_stack = QVBoxLayout()
+        # colour magnitude diagram, kept to update it in place
+        self.ax = None
+        self.calibration = None
+        self.colours = None  # (short, long) colour names for the axis labels
+        self.reddening = 0.
+        self.density = False
+        self.cmd_artist = None
+        self.points = None  # (n_stars, 2): colour index, magnitude
+        self.valid = None
+
+        self.button_stack = QVBoxLayout()
 
         save_button = QPushButton("Save Data")
         save_button.clicked.connect(self.save_button_clicked)
-        button_stack.addWidget(save_button)
+        self.button_stack.addWidget(save_button)
 
-        button_stack.addStretch()
+        self.button_stack.addStretch()
 
         self.layout = QHBoxLayout(self)
         self.layout.addWidget(self.figure_canvas)
-        self.layout.addLayout(button_stack)
+        self.layout.addLayout(self.button_stack)
 
         self.resize(800, 600)
 
@@ -53,7 +67,7 @@ class PlotWindow(QWidget):
         ax1.plot(range(1, len(offset[:, 0]) + 1), offset[:, 0])
 
         n_ticks_x = min(len(offset[:, 0]), 15)
-        n_ticks_y = min(abs(max(offset[:, 0]) - min(offset[:, 0])) + 2, 15)
+        n_ticks_y = int(min(abs(max(offset[:, 0]) - min(offset[:, 0])) + 2, 15))  # offsets may be sub-pixel
 
         ax1.set_yticks(np.linspace(min(offset[:, 0]) - 1, max(offset[:, 0]) + 1, n_ticks_y).astype(
             int))  # having only integers at the y axis
@@ -64,7 +78,7 @@ class PlotWindow(QWidget):
         ax2.plot(range(1, len(offset[:, 1]) + 1), offset[:, 1])
 
         n_ticks_x = min(len(offset[:, 1]), 15)
-        n_ticks_y = min(abs(max(offset[:, 1]) - min(offset[:, 1])) + 2, 15)
+        n_ticks_y = int(min(abs(max(offset[:, 1]) - min(offset[:, 1])) + 2, 15))  # offsets may be sub-pixel
 
         ax2.set_yticks(np.linspace(min(offset[:, 1]) - 1, max(offset[:, 1]) + 1, n_ticks_y).astype(
             int))  # having only integers at the y axis
@@ -83,69 +97,66 @@ class PlotWindow(QWidget):
             QMessageBox.information(self, "No valid Data", "Saving is only supported for FHD-Plots")
 
 
-    def plot_fhd(self, n_stars_min: int, stars: list[StarEllipse], input_cmd: dict, reddening: float):
-        ax = self.figure_canvas.figure.subplots()
-
-        labeled_stars = list(filter(lambda x: StarStatus.Labeled in x.status, stars))
-        n_ref_stars_1 = len(labeled_stars)
-
-        self.mag_short = np.zeros(n_stars_min)
-        self.mag_long = np.zeros(n_stars_min)
-
-        arbitrary_unit_mag = n_ref_stars_1 <= 0
-
-        if not arbitrary_unit_mag:
-            ref_flux = np.zeros((n_ref_stars_1, 2))
-            ref_mag_RGB = np.zeros((n_ref_stars_1, 2))
-            ref_mag_UBV = np.zeros((n_ref_stars_1, 2))
-
-            for i_ref_star, star in enumerate(labeled_stars):
-                ref_flux[i_ref_star, 0] = star.flux1
-                ref_flux[i_ref_star, 1] = star.flux2
-                ref_mag_UBV[i_ref_star, 0] = star.vmag1
-                ref_mag_UBV[i_ref_star, 1] = star.vmag2
-
-            # convert fluxes to magnitudes in our own filter system
-            ref_mag_RGB[:, :] = -2.5 * np.log10(ref_flux[:, :])
-
-            # find conversion from our RGB filters to Johnson UBV filters
-            fit_result_short = np.polyfit(ref_mag_RGB[:, 0], ref_mag_UBV[:, 0], 1)
-            fit_result_long = np.polyfit(ref_mag_RGB[:, 1], ref_mag_UBV[:, 1], 1)
-
-            RGB_UBV_converter_short = np.poly1d(fit_result_short)
-            RGB_UBV_converter_long = np.poly1d(fit_result_long)
-
-            for star in stars:
-                if star.flux1 > 0 and star.flux2 > 0:
-                    # convert to RGB mags
-                    mag_RGB_short = -2.5 * np.log10(star.flux1)
-                    mag_RGB_long = -2.5 * np.log10(star.flux2)
-                    # convert to UBV mags
-                    self.mag_short[star.index] = RGB_UBV_converter_short(mag_RGB_short)
-                    self.mag_long[star.index] = RGB_UBV_converter_long(mag_RGB_long)
-                else:
-                    self.mag_short[star.index] = None
-                    self.mag_long[star.index] = None
+    def plot_fhd(self, calibration: MagnitudeCalibration, input_cmd: dict, reddening: float, density: bool = False):
+        """
+        Colour magnitude diagram of the selected stars, drawn as one collection
+        density: show a hexbin density map instead of the single points (for rich clusters)
+        """
+        self.ax = self.figure_canvas.figure.subplots()
+        self.calibration = calibration
+        self.colours = (input_cmd['short_colour'], input_cmd['long_colour'])
+        self.reddening = reddening
+        self.ax.invert_yaxis()
+
+        density_button = QPushButton("Density")
+        density_button.setCheckable(True)
+        density_button.setChecked(density)
+        density_button.toggled.connect(self.density_button_toggled)
+        self.button_stack.insertWidget(1, density_button)
+
+        self.density = density
+        self.update_fhd()
+
+    def update_fhd(self, reddening: Optional[float] = None):
+        """Updates the points of the colour magnitude diagram in place (new selection, labels or reddening)"""
+        mag_short, mag_long = self.calibration.magnitudes()
+
+        # points of all stars are only recomputed if the calibration or the reddening changed, a new selection just masks them
+        if mag_short is not self.mag_short or mag_long is not self.mag_long or (reddening is not None and reddening != self.reddening):
+            self.mag_short, self.mag_long = mag_short, mag_long
+            if reddening is not None:
+                self.reddening = reddening
+
+            self.points = np.column_stack((self.mag_short - self.mag_long - self.reddening, self.mag_long))
+            self.valid = np.all(np.isfinite(self.points), axis=1)
+
+            # the unit changes, when the first star is labeled or the last label is removed
+            ex = "[mag]" if not self.calibration.arbitrary_unit else "[a.u.]"
+            self.ax.set_xlabel(f"Colour Index ({self.colours[0]}-{self.colours[1]}) {ex}")
+            self.ax.set_ylabel(f"{self.colours[1]} {ex}")
+
+        points = self.points[self.calibration.catalogue.selected & self.valid]
+
+        if self.density:
+            # hexbin can not be updated, so the collection is replaced
+            if self.cmd_artist is not None:
+                self.cmd_artist.remove()
+            self.cmd_artist = self.ax.hexbin(points[:, 0], points[:, 1], gridsize=self.hexbin_gridsize, bins="log", mincnt=1, cmap="Blues")
+        elif self.cmd_artist is None:
+            self.cmd_artist = self.ax.scatter(points[:, 0], points[:, 1], s=36, c="b")
         else:
-            ref_flux = [stars[0].flux1, stars[0].flux2]
-            ref_mag_UBV = [10, 10]
-
-            for star in stars:
-                if star.flux1 > 0 and star.flux2 > 0:
-                    self.mag_short[star.index] = -2.5 * np.log10(star.flux1 / ref_flux[0]) + ref_mag_UBV[0]
-                    self.mag_long[star.index] = -2.5 * np.log10(star.flux2 / ref_flux[1]) + ref_mag_UBV[1]
-                else:
-                    self.mag_short[star.index] = None
-                    self.mag_long[star.index] = None
-
-        colour_index = self.mag_short - self.mag_long
-        colour_index_0 = colour_index - reddening
+            self.cmd_artist.set_offsets(points)
 
-        ex = "[mag]" if not arbitrary_unit_mag else "[a.u.]"
-        ax.set_xlabel(f"Colour Index ({input_cmd['short_colour']}-{input_cmd['long_colour']}) {ex}")
-        ax.set_ylabel(f"{input_cmd['long_colour']} {ex}")
+        # collections are not considered by relim, so the data limits are set from the points
+        self.ax.ignore_existing_data_limits = True
+        self.ax.update_datalim(points)
+        self.ax.autoscale_view()
 
-        for star in filter(lambda x: StarStatus.Selected in x.status, stars):
-            ax.plot(colour_index_0[star.index], self.mag_long[star.index], 'bo')
+        self.figure_canvas.draw_idle()
 
-        ax.invert_yaxis()
\ No newline at end of file
+    @Slot(bool)
+    def density_button_toggled(self, checked: bool):
+        self.density = checked
+        self.cmd_artist.remove()
+        self.cmd_artist = None
+        self.update_fhd()
\ No newline at end of file
@@ -0,0 +1,65 @@
+from PySide6.QtCore import QObject, Signal, Slot
+
+from pipeline import Reduction, ReductionCancelled
+
+
+class ReductionWorker(QObject):
+    """
+    Runs a Reduction on a separate thread (see MainWindow.start_reduction)
+    Results are announced by signals as soon as they are available, so the window can be filled incrementally
+    """
+
+    # stage, frames done, frames in stage
+    progress = Signal(str, int, int)
+
+    # title, text of a warning (QMessageBox must not be used from the worker thread)
+    warning = Signal(str, str)
+
+    # emitted with the display stretches (stretch.Stretch) of the reference master, once the master lights are stacked
+    stacked = Signal(object)
+
+    # emitted once stars are detected and photometry is done
+    detected = Signal()
+
+    # emitted with the error message if the reduction failed
+    failed = Signal(str)
+
+    cancelled = Signal()
+
+    # emitted last, in any case
+    finished = Signal()
+
+    def __init__(self, reduction: Reduction):
+        super().__init__()
+
+        self.reduction = reduction
+
+        self.reduction.warn = self.warning.emit
+        self.reduction.progress = self.progress.emit
+
+    @Slot()
+    def run(self):
+        try:
+            if self.reduction.load():
+                self.reduction.stack()
+                self.reduction.save_fits_files()
+                with self.reduction.report.stage("Display"):
+                    stretch = self.reduction.display_stretch()
+                self.stacked.emit(stretch)
+
+                self.reduction.detect()
+                self.reduction.write_report()
+                self.detected.emit()
+
+        except ReductionCancelled:
+            self.cancelled.emit()
+
+        except Exception as e:
+            self.failed.emit(str(e))
+
+        finally:
+            self.finished.emit()
+
+    def cancel(self):
+        """Called from the GUI thread: the reduction stops at the next frame"""
+        self.reduction.cancel()
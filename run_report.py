@@ -0,0 +1,95 @@
+import util
+
+import cProfile
+import csv
+import json
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter, process_time
+from typing import Iterator, Optional
+
+
+class RunReport:
+    """
+    Measurements of the stages of one reduction: wall time, CPU time (of all threads), peak memory, frames and stars
+    peak_rss_mb is the high-water mark of the process at the end of a stage (see util.peak_rss_mb).
+    With trace_memory, peak_traced_mb is the peak of the memory allocated while the stage ran (tracemalloc),
+    exact per stage, but pure Python code runs slower while tracing.
+    The stage named profile_stage runs under cProfile (calling thread only, not the workers of the executor),
+    its statistics are written next to the report.
+    """
+
+    columns = ("stage", "wall_s", "cpu_s", "peak_rss_mb", "peak_traced_mb", "n_frames", "n_stars")
+
+    def __init__(self, trace_memory: bool = False, profile_stage: Optional[str] = None):
+        self.trace_memory = trace_memory
+        self.profile_stage = profile_stage
+        self.stages = []
+        self.profiles = {}  # stage -> cProfile.Profile
+
+    @contextmanager
+    def stage(self, name: str, n_frames: Optional[int] = None, n_stars: Optional[int] = None) -> Iterator[dict]:
+        """Measures the enclosed block; yields its record, so counts known only afterwards can be filled in"""
+        record = {"stage": name, "n_frames": n_frames, "n_stars": n_stars}
+
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+
+        profiler = cProfile.Profile() if name == self.profile_stage else None
+        wall = perf_counter()
+        cpu = process_time()
+
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self.profiles[name] = profiler
+
+            record["wall_s"] = perf_counter() - wall
+            record["cpu_s"] = process_time() - cpu
+            record["peak_rss_mb"] = util.peak_rss_mb()
+            record["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20 if self.trace_memory else None
+            self.stages.append(record)
+
+    @property
+    def total_wall_s(self) -> float:
+        return sum(record["wall_s"] for record in self.stages)
+
+    def summary(self) -> str:
+        lines = [f"Reduction took {self.total_wall_s:.2f} s"]
+        for record in self.stages:
+            counts = ", ".join(f"{record[key]} {key[2:]}" for key in ("n_frames", "n_stars") if record[key] is not None)
+            lines.append(f"  {record['stage']}: {record['wall_s']:.3f} s, CPU {record['cpu_s']:.3f} s" + (f", {counts}" if counts else ""))
+        return "\n".join(lines)
+
+    def write(self, path_result: Path | str, input_cmd: Optional[dict] = None) -> list[Path]:
+        """Writes the report as .json (with the configuration) and .csv, and the cProfile statistics (.prof) into path_result"""
+        path_result = Path(path_result)
+        path_result.mkdir(parents=True, exist_ok=True)
+        tme = datetime.now().strftime("%Y-%m-%dT%H-%M-%S")
+
+        json_file = path_result / f"run_report_{tme}.json"
+        with json_file.open("w") as fl:
+            json.dump({"date": tme, "total_wall_s": self.total_wall_s, "stages": self.stages, "input_cmd": input_cmd},
+                      fl, indent=2, default=str)
+
+        csv_file = path_result / f"run_report_{tme}.csv"
+        with csv_file.open("w", newline="") as fl:
+            writer = csv.DictWriter(fl, self.columns)
+            writer.writeheader()
+            writer.writerows(self.stages)
+
+        written = [json_file, csv_file]
+        for name, profiler in self.profiles.items():
+            profile_file = path_result / f"profile_{name.replace(' ', '_')}_{tme}.prof"
+            profiler.dump_stats(profile_file)
+            written.append(profile_file)
+
+        return written
@@ -0,0 +1,143 @@
+import numpy as np
+
+from executor import map_frames
+
+from concurrent.futures import Executor
+from typing import Callable, Optional
+
+# row length up to which count_below compares all elements instead of searching
+MAX_COMPARED = 1024
+
+
+def sample_frames(data: np.ndarray, max_pixels: Optional[int] = None, method: str = "stride", seed: int = 0) -> np.ndarray:
+    """
+    (n_frames, n_pixels) pixels of a stack used for the statistics, a view if all pixels are used
+    max_pixels: pixels per frame at most, all if None
+    method: "stride" takes every k-th row and column, "random" a fixed random choice (same pixels in every frame)
+    """
+    n_frames, n0, n1 = data.shape
+    if max_pixels is None or max_pixels >= n0 * n1:
+        return data.reshape(n_frames, -1)
+
+    match method:
+        case "stride":
+            step = int(np.ceil(np.sqrt(n0 * n1 / max_pixels)))
+            return data[:, ::step, ::step].reshape(n_frames, -1)
+        case "random":
+            index = np.sort(np.random.default_rng(seed).choice(n0 * n1, max_pixels, replace=False))
+            return np.array([frame.reshape(-1)[index] for frame in data])
+        case _:
+            raise ValueError(f"Unknown sampling {method}, expected stride or random")
+
+
+def count_below(rows: np.ndarray, stop: np.ndarray, values: np.ndarray, inclusive: bool) -> np.ndarray:
+    """
+    Number of elements of the sorted rows[i, :stop[i]] below (or equal to, if inclusive) values[i] for every row,
+    as np.searchsorted with side "left" ("right")
+    Short rows (e.g. sky annuli of many stars) are compared all at once, long rows (frames) are searched row by row.
+    """
+    if rows.shape[1] > MAX_COMPARED:
+        # values rounded to the dtype of rows, so searchsorted does not cast a copy of the row; the side keeps the count exact
+        rounded = values.astype(rows.dtype)
+        right = rounded <= values if inclusive else rounded < values
+        return np.array([np.searchsorted(row[:n], value, "right" if r else "left")
+                         for row, n, value, r in zip(rows, stop, rounded, right)], dtype=np.intp)
+
+    below = rows <= values[:, None] if inclusive else rows < values[:, None]
+    below &= np.arange(rows.shape[1]) < stop[:, None]
+    return np.count_nonzero(below, axis=1)
+
+
+def clipped_stats(samples: np.ndarray, sigma: float = 3., max_iter: int = 5) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Sigma clipped mean, median and standard deviation of every row of samples, as astropy's sigma_clipped_stats
+    Rows are sorted once: the unclipped values are then a range of each row, whose sums are read from cumulative sums,
+    so an iteration only moves the bounds of the ranges. nan values are ignored.
+    Works on one copy of samples (sorted in place), float32 if samples are, and its two float64 cumulative sums.
+    """
+    rows = np.array(samples, dtype=np.result_type(samples, np.float32))
+    rows.sort(axis=1)
+    n_rows = len(rows)
+    r = np.arange(n_rows)
+
+    # unclipped values of row i are rows[i, lo[i]:hi[i]]; nan are sorted to the end
+    lo = np.zeros(n_rows, dtype=np.intp)
+    hi = np.count_nonzero(~np.isnan(rows), axis=1)
+
+    # values relative to a typical one (in place), so squares do not lose precision
+    reference = rows[r, np.maximum(hi // 2 - 1, 0)].astype(np.float64)
+    rows -= reference[:, None]
+    np.nan_to_num(rows, copy=False)
+    sum1 = rows.astype(np.float64)
+    np.cumsum(sum1, axis=1, out=sum1)
+    sum2 = np.square(rows, dtype=np.float64)
+    np.cumsum(sum2, axis=1, out=sum2)
+
+    def range_sum(cumulative: np.ndarray, start: np.ndarray, stop: np.ndarray) -> np.ndarray:
+        """Sums of rows[i, start[i]:stop[i]]"""
+        last = np.where(stop > 0, cumulative[r, np.maximum(stop - 1, 0)], 0.)
+        first = np.where(start > 0, cumulative[r, np.maximum(start - 1, 0)], 0.)
+        return last - first
+
+    def stats() -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            count = hi - lo
+            mean = range_sum(sum1, lo, hi) / count
+            std = np.sqrt(np.maximum(range_sum(sum2, lo, hi) / count - mean ** 2, 0.))
+            upper = np.clip(lo + count // 2, 0, rows.shape[1] - 1)
+            lower = np.clip(lo + (count - 1) // 2, 0, rows.shape[1] - 1)
+            median = np.where(count > 0, 0.5 * (rows[r, lower] + rows[r, upper].astype(np.float64)), np.nan)
+        return mean, median, std
+
+    for _ in range(max_iter):
+        _, median, std = stats()
+        new_lo = count_below(rows, hi, median - sigma * std, inclusive=False)
+        new_hi = count_below(rows, hi, median + sigma * std, inclusive=True)
+
+        # clipped values stay clipped
+        new_lo = np.maximum(lo, new_lo)
+        new_hi = np.minimum(hi, new_hi)
+        if np.array_equal(new_lo, lo) and np.array_equal(new_hi, hi):
+            break
+        lo, hi = new_lo, new_hi
+
+    mean, median, std = stats()
+    return mean + reference, median + reference, std
+
+
+class SkyStats:
+    """
+    Sigma clipped statistics of whole stacks
+    Frames are processed in chunks (at most chunk_values sampled pixels at once) through an executor, each chunk in one
+    vectorized pass (see clipped_stats), optionally on a subsample of the pixels (see sample_frames).
+    """
+
+    chunk_values = 2 ** 21  # sampled pixels per chunk, bounds the memory of sorting and cumulative sums
+
+    def __init__(self, sigma: float = 3., max_iter: int = 5):
+        self.sigma = sigma
+        self.max_iter = max_iter
+
+    def chunk_stats(self, chunk: np.ndarray, max_pixels: Optional[int], method: str) -> np.ndarray:
+        return np.array(clipped_stats(sample_frames(chunk, max_pixels, method), self.sigma, self.max_iter))
+
+    def __call__(self, data: np.ndarray, executor: Optional[Executor] = None, progress: Optional[Callable[[int], None]] = None,
+                 max_pixels: Optional[int] = None, method: str = "stride") -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Mean, median and standard deviation per frame of data (n_frames, n0, n1), progress(n_done) per chunk of frames"""
+        n_frames, n0, n1 = data.shape
+        n_sampled = min(n0 * n1, max_pixels) if max_pixels is not None else n0 * n1
+        frames_per_chunk = max(1, self.chunk_values // n_sampled)
+        chunks = [data[i:i + frames_per_chunk] for i in range(0, n_frames, frames_per_chunk)]
+
+        def report(n_done: int):
+            progress(min(n_done * frames_per_chunk, n_frames))
+
+        results = map_frames(executor, self.chunk_stats, chunks, [max_pixels] * len(chunks), [method] * len(chunks),
+                             progress=report if progress is not None else None)
+        mean, median, std = np.hstack(results)
+
+        return mean, median, std
+
+
+# 3 sigma statistics of util.get_stats
+sky_stats = SkyStats()
@@ -0,0 +1,80 @@
+import numpy as np
+
+from enum import IntFlag
+from typing import Callable
+
+
+class StarStatus(IntFlag):
+    Deselected = 0b00
+    Selected = 0b01
+    Labeled = 0b10
+
+
+class StarCatalogue:
+    """
+    Columnar storage of all detected stars, indexed by star index
+    - positions: (n_fits, n_stars, 2) positions in the aligned master lights
+    - flux: (n_fits, n_stars) aperture sums (short, long)
+    - user_mag: (2, n_stars) user defined magnitudes (short, long), 0 if not set
+    - status: (n_stars,) StarStatus bits
+    """
+
+    def __init__(self, positions: np.ndarray, flux: np.ndarray):
+        self.positions = positions
+        self.flux = flux
+
+        n_stars = flux.shape[1]
+        self.user_mag = np.zeros((2, n_stars))
+        self.status = np.full(n_stars, StarStatus.Selected, dtype=np.uint8)
+
+        # callbacks listener(index) called with the indices of changed stars
+        self.listeners = []
+
+    def __len__(self) -> int:
+        return len(self.status)
+
+    @property
+    def selected(self) -> np.ndarray:
+        """Boolean mask of selected stars"""
+        return (self.status & StarStatus.Selected).astype(bool)
+
+    @property
+    def labeled(self) -> np.ndarray:
+        """Boolean mask of stars with user defined magnitudes"""
+        return (self.status & StarStatus.Labeled).astype(bool)
+
+    def subscribe(self, listener: Callable[[np.ndarray | slice | int], None]):
+        """listener(index) is called after the status or user defined magnitudes of the stars at index changed"""
+        self.listeners.append(listener)
+
+    def notify(self, index):
+        for listener in self.listeners:
+            listener(index)
+
+    def toggle_selection(self, index=slice(None)):
+        """Toggles selection of the stars at index (all by default)"""
+        self.status[index] ^= np.uint8(StarStatus.Selected)
+        self.notify(index)
+
+    def select(self, index=slice(None), selected: bool = True):
+        """Selects (or deselects) the stars at index (all by default)"""
+        if selected:
+            self.status[index] |= np.uint8(StarStatus.Selected)
+        else:
+            self.status[index] &= ~np.uint8(StarStatus.Selected)
+        self.notify(index)
+
+    def set_status(self, index: int, status: StarStatus):
+        self.status[index] = status
+        self.notify(index)
+
+    def set_user_mag(self, index: int, mag_short: float, mag_long: float):
+        """Sets user defined magnitudes of one star, both 0 unsets the star"""
+        self.user_mag[:, index] = mag_short, mag_long
+
+        if mag_short == 0.0 and mag_long == 0.0:
+            self.status[index] &= ~np.uint8(StarStatus.Labeled)
+        else:
+            self.status[index] |= np.uint8(StarStatus.Labeled)
+
+        self.notify(index)
@@ -1,37 +1,90 @@
-from PySide6.QtWidgets import QGraphicsView
-from PySide6.QtGui import QMouseEvent, QWheelEvent
-from PySide6.QtCore import Qt, QPoint, Signal
+from PySide6.QtWidgets import QGraphicsView, QGraphicsPathItem
+from PySide6.QtGui import QMouseEvent, QWheelEvent, QPainterPath, QPolygonF, QPen
+from PySide6.QtCore import Qt, QPoint, QPointF, QRectF, Signal
 
-from star_ellipse import StarStatus, StarEllipse
+import numpy as np
 
-from typing import Optional, Iterator
+from star_catalogue import StarCatalogue
+from star_overlay import StarOverlay
+
+from typing import Optional
 
 
 class StarGraphicsView(QGraphicsView):
     """
     Display class showing converted fits file as star-image
     Provides framework for Mouse-interactions
+    Markers of all stars are drawn by one StarOverlay (see set_stars), hit-tests and selections are answered
+    by its KD-tree over the star positions instead of searching the items of the scene.
     """
 
-    # Signal emitted when parameters of a star should be set
-    star_chosen = Signal(StarEllipse)
+    # Signal emitted with the index of a star, whose parameters should be set
+    star_chosen = Signal(int)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-    def stars(self) -> Iterator[StarEllipse]:
-        """
-        Returns all StarEllipse instances in the currently held scene
-        Should be used, as the starmap (pixmap) is also one item of self.scene
-        """
+        self.catalogue = None
+        self.overlay = None
 
-        return filter(lambda x: isinstance(x, StarEllipse), self.scene().items())
+        # polygon and its outline while a lasso selection is drawn
+        self.lasso = None
+        self.lasso_item = None
 
-    def get_star_at(self, pos: QPoint) -> Optional[StarEllipse]:
-        """Returns the StarEllipse instance at position pos or None"""
-        if (star := self.itemAt(pos)) and isinstance(star, StarEllipse):
-            return star
-        return None
+    def set_stars(self, catalogue: StarCatalogue, positions: np.ndarray, marker_radius: float, colours: tuple[str, str] = ("short", "long")):
+        """
+        Adds the markers of the stars of catalogue, positions: (n_stars, 2) scene coordinates
+        marker_radius: radius of the markers, clicks within it hit the star
+        colours: names of the colours shown in tooltips
+        """
+        if self.overlay is not None:
+            self.scene().removeItem(self.overlay)
+
+        self.catalogue = catalogue
+        self.overlay = StarOverlay(catalogue, positions, marker_radius, colours)
+        self.scene().addItem(self.overlay)
+
+    def update_pens(self):
+        """Repaints the markers after the status of stars was changed in the catalogue"""
+        if self.overlay is not None:
+            self.overlay.update()
+
+    def stars_within(self, pos: QPointF, radius: float) -> np.ndarray:
+        """Indices of the stars within radius around pos (scene coordinates)"""
+        if self.overlay is None:
+            return np.empty(0, dtype=np.intp)
+        return self.overlay.stars_within(pos.x(), pos.y(), radius)
+
+    def stars_in_rect(self, rect: QRectF) -> np.ndarray:
+        """Indices of the stars with positions inside rect (scene coordinates)"""
+        if self.overlay is None:
+            return np.empty(0, dtype=np.intp)
+        return self.overlay.stars_in_rect(rect)
+
+    def stars_in_polygon(self, polygon: QPolygonF) -> np.ndarray:
+        """Indices of the stars with positions inside polygon (scene coordinates)"""
+        index = self.stars_in_rect(polygon.boundingRect())
+        inside = [polygon.containsPoint(QPointF(*self.overlay.positions[j]), Qt.FillRule.OddEvenFill) for j in index]
+        return index[np.array(inside, dtype=bool)]
+
+    def get_star_at(self, pos: QPoint) -> Optional[int]:
+        """Returns the index of the star at position pos (view coordinates) or None"""
+        if self.overlay is None:
+            return None
+
+        scene_pos = self.mapToScene(pos)
+        return self.overlay.star_at(scene_pos.x(), scene_pos.y())
+
+    def select_all(self, selected: bool = True):
+        """Selects (or deselects) all stars"""
+        self.catalogue.select(slice(None), selected)
+        self.update_pens()
+
+    def toggle_stars(self, index: np.ndarray):
+        """Toggles selection of the stars at index at once, so listeners of the catalogue are informed only once"""
+        if len(index) > 0:
+            self.catalogue.toggle_selection(index)
+            self.update_pens()
 
     def mousePressEvent(self, event: QMouseEvent):
         match event.button():
@@ -47,26 +100,49 @@ class StarGraphicsView(QGraphicsView):
                     case Qt.KeyboardModifier.ControlModifier:
                         self.setDragMode(QGraphicsView.DragMode.ScrollHandDrag)
 
+                    # Press alt to draw a lasso around stars
+                    case Qt.KeyboardModifier.AltModifier:
+                        self.lasso = QPolygonF([self.mapToScene(event.pos())])
+                        self.lasso_item = QGraphicsPathItem()
+                        self.lasso_item.setPen(QPen(Qt.GlobalColor.yellow, 0))
+                        self.scene().addItem(self.lasso_item)
+
                     # No modifiers: just toggle star
                     case _:
                         self.toggle_selection(event.pos())
 
         # Signal MainWindow that we would like to set parameters for this particular star
             case Qt.MouseButton.RightButton:
-                if star := self.get_star_at(event.pos()):
-                    self.star_chosen.emit(star)
+                if (index := self.get_star_at(event.pos())) is not None:
+                    self.star_chosen.emit(index)
 
             case _:
                 pass
 
         super().mousePressEvent(event)
 
+    def mouseMoveEvent(self, event: QMouseEvent):
+        if self.lasso is not None:
+            self.lasso.append(self.mapToScene(event.pos()))
+            path = QPainterPath()
+            path.addPolygon(self.lasso)
+            self.lasso_item.setPath(path)
+
+        super().mouseMoveEvent(event)
+
     def mouseReleaseEvent(self, event: QMouseEvent):
-        # Select stars with rubber band
-        if event.button() == Qt.MouseButton.LeftButton and self.dragMode() == QGraphicsView.DragMode.RubberBandDrag:
-            select_rect = self.mapToScene(self.rubberBandRect())
-            for star in filter(lambda x: isinstance(x, StarEllipse), self.scene().items(select_rect)):
-                star.status ^= StarStatus.Selected
+        if event.button() == Qt.MouseButton.LeftButton:
+            # Select stars with rubber band
+            if self.dragMode() == QGraphicsView.DragMode.RubberBandDrag:
+                select_rect = self.mapToScene(self.rubberBandRect()).boundingRect()
+                self.toggle_stars(self.stars_in_rect(select_rect))
+
+            # Select stars with lasso
+            if self.lasso is not None:
+                self.scene().removeItem(self.lasso_item)
+                self.toggle_stars(self.stars_in_polygon(self.lasso))
+                self.lasso = None
+                self.lasso_item = None
 
         self.setDragMode(QGraphicsView.DragMode.NoDrag)
         super().mouseReleaseEvent(event)
@@ -77,6 +153,6 @@ class StarGraphicsView(QGraphicsView):
         self.setTransform(self.transform().scale(z, z))
 
     def toggle_selection(self, pos: QPoint):
-        """Toggles selection of a star. star.status is a property, handling everything concerning graphics etc."""
-        if star := self.get_star_at(pos):
-            star.status ^= StarStatus.Selected
\ No newline at end of file
+        """Toggles selection of the star at pos (view coordinates)"""
+        if (index := self.get_star_at(pos)) is not None:
+            self.toggle_stars(np.array([index]))
\ No newline at end of file
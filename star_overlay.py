@@ -0,0 +1,131 @@
+from PySide6.QtWidgets import QGraphicsItem, QGraphicsSceneHoverEvent, QStyleOptionGraphicsItem
+from PySide6.QtGui import QImage, QPainter, QPen
+from PySide6.QtCore import QPointF, QRectF
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from star_catalogue import StarCatalogue, StarStatus
+
+from typing import Optional
+
+
+class Pens:
+    """Used to color markers around stars depending on their status"""
+
+    Deselected = QPen("red")
+    Selected = QPen("green")
+    DeselectedLabeled = QPen("orange")
+    SelectedLabeled = QPen("blue")
+
+    @staticmethod
+    def from_status(star_status: StarStatus) -> QPen:
+        return [Pens.Deselected, Pens.Selected,
+                Pens.DeselectedLabeled, Pens.SelectedLabeled][star_status]
+
+
+class StarOverlay(QGraphicsItem):
+    """
+    Markers around all stars of a catalogue, drawn by one item
+    Only stars inside the exposed rect are painted, grouped by status so the pen changes at most four times.
+    If markers get smaller than density_threshold pixels (zoomed out), cells of density_cell pixels are drawn instead,
+    more opaque the more stars they contain.
+    Labeled stars show their user defined magnitudes when hovering over them.
+    """
+
+    density_threshold = 2.  # marker radius on screen in pixels, below which density cells are drawn
+    density_cell = 8.  # size of density cells on screen in pixels
+
+    def __init__(self, catalogue: StarCatalogue, positions: np.ndarray, marker_radius: float, colours: tuple[str, str] = ("short", "long")):
+        super().__init__()
+
+        self.catalogue = catalogue
+        self.positions = np.asarray(positions, dtype=np.float64)
+        self.tree = cKDTree(self.positions)
+        self.marker_radius = marker_radius
+        self.colours = colours
+
+        margin = marker_radius + 1
+        x_min, y_min = self.positions.min(axis=0) if len(self.positions) else (0, 0)
+        x_max, y_max = self.positions.max(axis=0) if len(self.positions) else (0, 0)
+        self.__bounding_rect = QRectF(x_min - margin, y_min - margin, x_max - x_min + 2 * margin, y_max - y_min + 2 * margin)
+
+        # exposedRect of the style option is needed for culling
+        self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemUsesExtendedStyleOption)
+        self.setAcceptHoverEvents(True)
+        self.setZValue(1)
+
+    def boundingRect(self) -> QRectF:
+        return self.__bounding_rect
+
+    def stars_within(self, x: float, y: float, radius: float) -> np.ndarray:
+        """Indices of the stars within radius around x, y"""
+        return np.asarray(self.tree.query_ball_point((x, y), radius), dtype=np.intp)
+
+    def stars_in_rect(self, rect: QRectF) -> np.ndarray:
+        """Indices of the stars with positions inside rect"""
+        # square search (maximum norm) around the center, covering the rect
+        center = rect.center()
+        index = np.asarray(self.tree.query_ball_point((center.x(), center.y()), max(rect.width(), rect.height()) / 2, p=np.inf), dtype=np.intp)
+
+        xy = self.positions[index]
+        inside = ((xy[:, 0] >= rect.left()) & (xy[:, 0] <= rect.right())
+                  & (xy[:, 1] >= rect.top()) & (xy[:, 1] <= rect.bottom()))
+        return index[inside]
+
+    def star_at(self, x: float, y: float) -> Optional[int]:
+        """Index of the nearest star, whose marker contains x, y, or None"""
+        distance, index = self.tree.query((x, y), distance_upper_bound=self.marker_radius)
+        return int(index) if np.isfinite(distance) else None
+
+    def paint(self, painter: QPainter, option: QStyleOptionGraphicsItem, widget=None):
+        r = self.marker_radius
+        index = self.stars_in_rect(option.exposedRect.adjusted(-r, -r, r, r))
+        if len(index) == 0:
+            return
+
+        xy = self.positions[index]
+        status = self.catalogue.status[index]
+        lod = option.levelOfDetailFromTransform(painter.worldTransform())
+
+        if lod * r < self.density_threshold:
+            self.paint_density(painter, xy, status, self.density_cell / lod)
+            return
+
+        for star_status in range(4):
+            painter.setPen(Pens.from_status(star_status))
+            for x, y in xy[status == star_status]:
+                painter.drawEllipse(QPointF(x, y), r, r)
+
+    def paint_density(self, painter: QPainter, xy: np.ndarray, status: np.ndarray, cell: float):
+        """
+        One square per occupied cell, opacity increasing with the (log) number of stars in it
+        Cells are coloured by the status most of their stars have, and drawn as one image
+        """
+        cells = np.floor(xy / cell).astype(np.int64)
+        origin = cells.min(axis=0)
+        nx, ny = cells.max(axis=0) - origin + 1
+        flat = (cells[:, 1] - origin[1]) * nx + (cells[:, 0] - origin[0])
+
+        counts = np.bincount(status.astype(np.int64) * (ny * nx) + flat, minlength=4 * ny * nx).reshape(4, ny * nx)
+        colours = np.array([Pens.from_status(star_status).color().getRgb() for star_status in range(4)], dtype=np.uint8)
+
+        rgba = colours[np.argmax(counts, axis=0)]
+        total = counts.sum(axis=0)
+        rgba[:, 3] = np.where(total > 0, 100 + 155 * np.minimum(np.log2(np.maximum(total, 1)).astype(int), 3) // 3, 0)
+        rgba = rgba.reshape(ny, nx, 4)
+
+        image = QImage(rgba.data, nx, ny, 4 * nx, QImage.Format.Format_RGBA8888)
+        painter.drawImage(QRectF(origin[0] * cell, origin[1] * cell, nx * cell, ny * cell), image)
+
+    def hoverMoveEvent(self, event: QGraphicsSceneHoverEvent):
+        """Tooltip with the user defined magnitudes of a labeled star"""
+        index = self.star_at(event.pos().x(), event.pos().y())
+
+        if index is not None and StarStatus.Labeled & self.catalogue.status[index]:
+            mag_short, mag_long = self.catalogue.user_mag[:, index]
+            self.setToolTip(f"{self.colours[0]}: {mag_short} | {self.colours[1]}: {mag_long}")
+        else:
+            self.setToolTip("")
+
+        super().hoverMoveEvent(event)
@@ -0,0 +1,93 @@
+import numpy as np
+from astropy.visualization import ZScaleInterval
+
+STRETCHES = ("linear", "log", "asinh", "sqrt", "histeq", "zscale")
+
+
+class Stretch:
+    """
+    Display stretches of one master frame as lookup tables
+    The frame is quantized once to 16 bit indices over its value range; a stretch is a LUT mapping
+    these indices to 8 bit grey values, so changing it does not touch the frame itself.
+    Black and white points are given in data units, values outside are clipped.
+    "zscale" is a linear stretch between the IRAF zscale limits, ignoring the given points.
+    LUTs are cached by (kind, black, white).
+    """
+
+    n_levels = 2 ** 16
+    log_factor = 1000.  # a of log10(a * x + 1) / log10(a)
+    asinh_factor = 10.  # b of asinh(b * x) / asinh(b)
+
+    def __init__(self, frame: np.ndarray, sky: float | None = None):
+        """sky: background of the frame if already known (e.g. the sigma clipped median of Reduction), default black point"""
+        self.low = float(np.nanmin(frame))
+        self.high = float(np.nanmax(frame))
+        if not self.high > self.low:
+            self.high = self.low + 1.
+
+        self.scale = (self.n_levels - 1) / (self.high - self.low)
+        self.quantized = np.clip(np.nan_to_num((frame - self.low) * self.scale), 0, self.n_levels - 1).astype(np.uint16)
+        self.histogram = np.bincount(self.quantized.ravel(), minlength=self.n_levels)
+
+        if sky is not None:
+            self.median = float(sky)
+        else:
+            # median from the histogram, precise to one quantization step
+            median_index = np.searchsorted(np.cumsum(self.histogram), self.quantized.size / 2)
+            self.median = float(self.low + median_index / self.scale)
+
+        # zscale on a subsample, as the limits hardly depend on every pixel
+        step = max(1, int(np.sqrt(frame.size / 250_000)))
+        self.zscale_limits = tuple(float(v) for v in ZScaleInterval().get_limits(frame[::step, ::step]))
+
+        self.__luts = {}
+
+    def default_points(self) -> tuple[float, float]:
+        """Black point at the sky background (median), white point at the maximum"""
+        return self.median, self.high
+
+    def index(self, value: float) -> float:
+        """Quantized index of a value in data units"""
+        return (value - self.low) * self.scale
+
+    def lut(self, kind: str = "log", black: float | None = None, white: float | None = None) -> np.ndarray:
+        """uint8 grey value for every quantized index"""
+        if kind == "zscale":
+            black, white = self.zscale_limits
+        else:
+            default_black, default_white = self.default_points()
+            black = default_black if black is None else black
+            white = default_white if white is None else white
+
+        key = (kind, black, white)
+        if key in self.__luts:
+            return self.__luts[key]
+
+        first = self.index(black)
+        last = max(self.index(white), first + 1e-9)
+        x = np.clip((np.arange(self.n_levels) - first) / (last - first), 0., 1.)
+
+        match kind:
+            case "linear" | "zscale":
+                y = x
+            case "log":
+                y = np.log10(self.log_factor * x + 1) / np.log10(self.log_factor)
+            case "asinh":
+                y = np.arcsinh(self.asinh_factor * x) / np.arcsinh(self.asinh_factor)
+            case "sqrt":
+                y = np.sqrt(x)
+            case "histeq":
+                # cumulative histogram of the pixels between black and white point
+                inside = (np.arange(self.n_levels) >= first) & (np.arange(self.n_levels) <= last)
+                cdf = np.cumsum(np.where(inside, self.histogram, 0))
+                y = cdf / cdf[-1] if cdf[-1] > 0 else x
+            case _:
+                raise ValueError(f"Unknown stretch {kind}, expected one of {', '.join(STRETCHES)}")
+
+        lut = np.round(y * 255).astype(np.uint8)
+        self.__luts[key] = lut
+        return lut
+
+    def render(self, kind: str = "log", black: float | None = None, white: float | None = None) -> np.ndarray:
+        """Stretched 8 bit image of the whole frame"""
+        return self.lut(kind, black, white)[self.quantized]
@@ -0,0 +1,116 @@
+import numpy as np
+from astropy.io import fits
+from scipy.special import erf
+
+from pathlib import Path
+from typing import Optional
+
+
+def render_stars(shape: tuple[int, int], xy: np.ndarray, flux: np.ndarray, fwhm: float) -> np.ndarray:
+    """
+    Image of circular Gaussian stars, xy: (n, 2) positions (x, y) with pixel centres at integer coordinates
+    Every pixel gets the integral of the PSF over its area, so the sum over a star is its flux (up to the cut at 4 sigma)
+    """
+    sigma = fwhm / (2 * np.sqrt(2 * np.log(2)))
+    half = int(np.ceil(4 * sigma))
+    grid = np.arange(-half, half + 1)
+
+    centre = np.round(xy).astype(np.int64)
+    # 1D integrals over the pixels around the rounded centres, the 2D PSF is their outer product
+    edges = grid[None, :, None] + centre[:, None, :] - xy[:, None, :]  # (n, k, 2)
+    scale = 1 / (np.sqrt(2) * sigma)
+    profile = 0.5 * (erf((edges + 0.5) * scale) - erf((edges - 0.5) * scale))
+    values = flux[:, None, None] * profile[:, :, None, 1] * profile[:, None, :, 0]  # (n, k_y, k_x)
+
+    y = centre[:, None, None, 1] + grid[None, :, None]
+    x = centre[:, None, None, 0] + grid[None, None, :]
+    y, x, values = np.broadcast_arrays(y, x, values)
+    inside = (y >= 0) & (y < shape[0]) & (x >= 0) & (x < shape[1])
+
+    image = np.bincount(y[inside] * shape[1] + x[inside], weights=values[inside], minlength=shape[0] * shape[1])
+    return image.reshape(shape)
+
+
+def write_frames(directory: Path, frames: list[np.ndarray], prefix: str = "frame") -> list[Path]:
+    """
+    Writes frames as unsigned 16 bit fits files (BZERO = 32768) into directory
+    Frames are flipped, as they are flipped back on reading (see FrameSource)
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    names = []
+
+    for i, frame in enumerate(frames):
+        data = np.clip(np.round(np.flip(frame)), 0, 2 ** 16 - 1).astype(np.uint16)
+        name = directory / f"{prefix}_{i:03d}.fits"
+        fits.PrimaryHDU(data=data).writeto(name, overwrite=True)
+        names.append(name)
+
+    return names
+
+
+def make_field(directory: Path | str, shape: tuple[int, int] = (1024, 1024), n_frames: tuple[int, int] = (4, 4),
+               density: float = 500., fwhm: float = 2.3, dither: int = 8, sky: float = 1000., read_noise: float = 5.,
+               gain: float = 1., flux_range: tuple[float, float] = (2e3, 2e5), dark: Optional[float] = None,
+               vignetting: Optional[float] = None, seed: int = 0) -> tuple[dict, dict]:
+    """
+    Writes a synthetic field (short and long wave lights, optionally darks and flats) into directory
+    density: stars per megapixel, log-uniform fluxes within flux_range, long wave flux differs by a random colour
+    Frames are dithered by random integer offsets up to dither pixels, the first short wave frame is not shifted.
+    Noise: Poisson (gain in e-/ADU) and Gaussian read noise in ADU.
+    dark: mean dark level in ADU, writes darks and adds their pattern to the lights
+    vignetting: relative loss of light in the corners, writes flats and applies them to the lights
+    Returns input_cmd for Reduction and the truth: positions (n, 2) in the coordinates of the first short wave frame, flux (2, n)
+    """
+    directory = Path(directory)
+    rng = np.random.default_rng(seed)
+    n0, n1 = shape
+
+    # stars stay inside every frame, whatever its offset
+    margin = dither + 4 * fwhm
+    n_stars = max(1, int(round(density * n0 * n1 / 1e6)))
+    xy = np.column_stack((rng.uniform(margin, n1 - 1 - margin, n_stars), rng.uniform(margin, n0 - 1 - margin, n_stars)))
+    flux_short = np.exp(rng.uniform(np.log(flux_range[0]), np.log(flux_range[1]), n_stars))
+    colour = rng.uniform(-0.5, 1.5, n_stars)
+    flux = np.vstack((flux_short, flux_short * 10 ** (-0.4 * colour)))
+
+    pattern = rng.normal(dark, 0.1 * dark, shape) if dark is not None else np.zeros(shape)
+
+    flat = np.ones(shape)
+    if vignetting is not None:
+        y, x = np.ogrid[:n0, :n1]
+        r2 = ((y - n0 / 2) / (n0 / 2)) ** 2 + ((x - n1 / 2) / (n1 / 2)) ** 2
+        flat = 1 - vignetting * r2 / 2
+        flat /= np.median(flat)
+
+    def noisy(signal: np.ndarray) -> np.ndarray:
+        return rng.poisson(np.maximum(signal, 0) * gain) / gain + rng.normal(0, read_noise, shape)
+
+    input_cmd = {
+        "path_result": str(directory / "results"),
+        "do_dark": dark is not None, "do_flat": vignetting is not None, "do_dark_flat": False,
+        "short_colour": "B", "long_colour": "V",
+        "FWHM": fwhm, "ratio": 1.0, "threshold": 30.0, "r_aperture": 1.5, "gain": gain,
+        "executor": "serial",
+    }
+
+    for c, colour_dir in enumerate(("short", "long")):
+        offsets = rng.integers(-dither, dither + 1, (n_frames[c], 2))
+        if c == 0:
+            offsets[0] = 0
+
+        # frame i shows the stars moved by its offset (dy, dx)
+        lights = [noisy((render_stars(shape, xy + offset[::-1], flux[c], fwhm) + sky) * flat) + pattern for offset in offsets]
+        write_frames(directory / "lights" / colour_dir, lights)
+        input_cmd[f"path_light_{colour_dir}"] = str(directory / "lights" / colour_dir)
+
+        if dark is not None:
+            write_frames(directory / "darks" / colour_dir, [pattern + rng.normal(0, read_noise, shape) for _ in range(3)])
+        input_cmd[f"path_dark_{colour_dir}"] = str(directory / "darks" / colour_dir)
+
+        if vignetting is not None:
+            write_frames(directory / "flats" / colour_dir, [noisy(20000. * flat) for _ in range(3)])
+        input_cmd[f"path_flat_{colour_dir}"] = str(directory / "flats" / colour_dir)
+
+    input_cmd["path_dark_flat"] = str(directory / "darks" / "flat")
+
+    return input_cmd, {"positions": xy, "flux": flux}
@@ -0,0 +1,34 @@
+import numpy as np
+from astropy.io import fits
+
+import batch
+
+
+def catalogue(n):
+    return {"ID": np.arange(n), "x": np.linspace(0., 10., n), "y": np.linspace(5., 1., n)}, {"NSTARS": n}
+
+
+def test_append_fields_with_same_config_name(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path_append = tmp_path / "catalogues.fits"
+    configs = [tmp_path / "field1" / "input_cmd.toml", tmp_path / "field2" / "input_cmd.toml"]
+
+    for n, path_config in zip((3, 5), configs):
+        batch.report(path_config, "", catalogue(n), path_append)
+
+    with fits.open(path_append) as hdul:
+        assert [hdu.name for hdu in hdul[1:]] == ["FIELD1/INPUT_CMD", "FIELD2/INPUT_CMD"]
+        assert len(hdul["FIELD1/INPUT_CMD"].data) == 3
+        assert hdul["FIELD2/INPUT_CMD"].header["NSTARS"] == 5
+
+
+def test_append_field_again(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path_append = tmp_path / "catalogues.fits"
+
+    for n in (3, 4):
+        batch.report(tmp_path / "input_cmd.toml", "", catalogue(n), path_append)
+
+    with fits.open(path_append) as hdul:
+        assert len(hdul[("INPUT_CMD", 1)].data) == 3
+        assert len(hdul[("INPUT_CMD", 2)].data) == 4
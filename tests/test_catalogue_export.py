@@ -0,0 +1,47 @@
+import numpy as np
+
+import catalogue_export
+
+
+def columns(n=20, seed=0):
+    rng = np.random.default_rng(seed)
+    flux = rng.lognormal(8., 1., (2, n))
+    mag = -2.5 * np.log10(flux)
+    mag[0, 3] = np.nan
+    return {
+        "ID": np.arange(n, dtype=np.int64), "x": rng.uniform(0, 2048, n), "y": rng.uniform(0, 2048, n),
+        "flux_B": flux[0], "flux_V": flux[1], "B_mag": mag[0], "V_mag": mag[1],
+        "flux_err_B": np.sqrt(flux[0]), "flux_err_V": np.sqrt(flux[1]),
+        "B_mag_err": 1. / np.sqrt(flux[0]), "V_mag_err": 1. / np.sqrt(flux[1]),
+        "sky_B": np.full(n, 100.5), "sky_V": np.full(n, 90.25), "status": np.ones(n, dtype=np.uint8),
+    }
+
+
+def legacy_dat(c):
+    """.dat file as written by MainWindow.save_fhd_files before catalogue_export"""
+    lines = [f"#ID\tx[px]\ty[px]\tflux_B[ADU]\tflux_V[ADU]\tB_mag\tV_mag\n"]
+    lines += [f"{i}\t{c['x'][i]}\t{c['y'][i]}\t{c['flux_B'][i]}\t{c['flux_V'][i]}\t{c['B_mag'][i]}\t{c['V_mag'][i]}\n" for i in c["ID"]]
+    return "".join(lines)
+
+
+def test_dat_as_legacy(tmp_path):
+    c = columns()
+    path, = catalogue_export.write_catalogue(tmp_path / "table", c, formats=["dat"])
+    assert path.read_text() == legacy_dat(c)
+
+
+def test_dat_extended(tmp_path):
+    c = columns()
+    path, = catalogue_export.write_catalogue(tmp_path / "table", c, formats=["dat"], dat_extended=True)
+    lines = path.read_text().splitlines()
+    assert lines[0].split("\t") == ["#ID", "x[px]", "y[px]", "flux_B[ADU]", "flux_V[ADU]", "B_mag", "V_mag", "flux_err_B[ADU]",
+                                    "flux_err_V[ADU]", "B_mag_err", "V_mag_err", "sky_B[ADU]", "sky_V[ADU]", "status"]
+    assert lines[1:] == [line[:-1] + "\t" + "\t".join(str(c[name][i]) for name in list(c)[7:])
+                         for i, line in enumerate(legacy_dat(c).splitlines(keepends=True)[1:])]
+
+
+def test_other_formats_have_all_columns(tmp_path):
+    c = columns()
+    npz, npy = catalogue_export.write_catalogue(tmp_path / "table", c, formats=["npz", "npy"])
+    assert list(np.load(npz)) == list(c)
+    assert np.load(npy).dtype.names == tuple(c)
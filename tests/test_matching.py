@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+import util
+
+
+def match_old(source_xy):
+    """Nested loop cross-matching of detect_star before the cKDTree rewrite, kept as reference"""
+    list_stars = np.empty([0, 2])
+
+    for xy in source_xy:
+        for x, y in xy:
+            new_star_in_list = False
+            for star in list_stars:
+                if abs(x - star[0]) <= 4 and abs(y - star[1]) <= 4:
+                    new_star_in_list = True
+                    break
+            if not new_star_in_list:
+                list_stars = np.r_[list_stars, np.array([[x, y]])]
+
+    first_match = np.full((len(list_stars), len(source_xy)), -1, dtype=np.intp)
+    for i_fits, xy in enumerate(source_xy):
+        for i_star, star in enumerate(list_stars):
+            for i_source, (x, y) in enumerate(xy):
+                if abs(x - star[0]) <= 4 and abs(y - star[1]) <= 4:
+                    first_match[i_star, i_fits] = i_source
+                    break
+
+    return list_stars, first_match
+
+
+def random_sources(rng, n_fits, n_stars, size):
+    """Jittered copies of one field, positions on a grid of 1/4 pixel, so distances of exactly 4 are frequent"""
+    field = rng.integers(0, size * 4, (n_stars, 2)) / 4
+    sources = []
+    for _ in range(n_fits):
+        keep = rng.random(n_stars) < 0.8
+        xy = field[keep] + rng.integers(-8, 9, (np.count_nonzero(keep), 2)) / 4
+        # additional spurious sources
+        xy = np.r_[xy, rng.integers(0, size * 4, (rng.integers(0, 5), 2)) / 4]
+        sources.append(xy[rng.permutation(len(xy))])
+    return sources
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_matching_as_nested_loops(seed):
+    rng = np.random.default_rng(seed)
+    source_xy = random_sources(rng, rng.integers(1, 6), rng.integers(1, 60), rng.choice([20, 60, 200]))
+
+    expected_stars, expected_first = match_old(source_xy)
+    list_stars = util.match_sources(source_xy)
+
+    np.testing.assert_array_equal(list_stars, expected_stars)
+    np.testing.assert_array_equal(util.first_matches(source_xy, list_stars), expected_first)
+
+
+def test_matching_tolerance_is_inclusive():
+    source_xy = [np.array([[10., 10.]]), np.array([[14., 6.], [14.25, 10.]])]
+
+    list_stars = util.match_sources(source_xy)
+
+    # (14, 6) lies exactly at tolerance 4 in x and y and matches, (14.25, 10) is a new star
+    np.testing.assert_array_equal(list_stars, [[10., 10.], [14.25, 10.]])
+    np.testing.assert_array_equal(util.first_matches(source_xy, list_stars), [[0, 0], [-1, 0]])
+
+
+def test_matching_empty_frames():
+    source_xy = [np.empty((0, 2)), np.array([[5., 5.]]), np.empty((0, 2))]
+
+    expected_stars, expected_first = match_old(source_xy)
+
+    np.testing.assert_array_equal(util.match_sources(source_xy), expected_stars)
+    np.testing.assert_array_equal(util.first_matches(source_xy, expected_stars), expected_first)
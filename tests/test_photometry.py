@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+from astropy.stats import sigma_clipped_stats
+from photutils.aperture import CircularAperture, aperture_photometry
+
+import util
+
+
+@pytest.fixture
+def frames():
+    rng = np.random.default_rng(3)
+    return rng.normal(100., 5., (2, 120, 100)).astype(np.float32)
+
+
+@pytest.mark.parametrize("radius", [1., 2., 3.45, 5.])
+def test_flux_as_exact_apertures(frames, radius):
+    rng = np.random.default_rng(4)
+    # includes stars partly outside the frame
+    positions = rng.uniform(-1., 101., (2, 300, 2))
+    median = np.full(2, 100.)
+
+    flux, _, _ = util.photometry(frames, median, np.full(2, 5.), positions, radius, chunk=64)
+
+    for i in range(2):
+        expected = aperture_photometry(frames[i] - np.float32(median[i]), CircularAperture(positions[i], radius), method="exact")
+        np.testing.assert_allclose(flux[i], np.nan_to_num(expected["aperture_sum"]), rtol=0, atol=1e-9)
+
+
+def test_annulus_sky_is_sigma_clipped(frames):
+    positions = np.array([[[50.3, 60.7]], [[50.3, 60.7]]])
+    # a bright neighbour inside the ring of the first frame
+    frames[0, 55:65, 55:60] += 1000.
+
+    _, _, sky = util.photometry(frames, np.full(2, 100.), np.full(2, 5.), positions, 3., annulus=(6., 9.))
+
+    y, x = np.mgrid[-10:11, -10:11]
+    ring = (np.hypot(x, y) >= 6.) & (np.hypot(x, y) <= 9.)
+    for i in range(2):
+        pixels = frames[i, 61 - 10:61 + 11, 50 - 10:50 + 11][ring]
+        assert sky[i, 0] == pytest.approx(sigma_clipped_stats(pixels)[1], abs=1e-9)
+    assert abs(sky[0, 0] - 100.) < 2.
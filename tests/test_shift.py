@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+from scipy import signal
+
+import util
+
+
+def shift_data_old(data, offset):
+    """Pad and slice shift of MainWindow.shift_data before the rewrite, kept as reference"""
+    n0, n1 = data.shape[1:]
+    for i in range(len(data)):
+        upper0 = abs(max(0, offset[i, 0]))
+        lower0 = abs(min(0, offset[i, 0]))
+        upper1 = abs(max(0, offset[i, 1]))
+        lower1 = abs(max(0, offset[i, 1]))
+        tmp = np.pad(data[i], ((upper0, lower0), (upper1, lower1)), mode='constant')
+        data[i] = tmp[lower0: n0 + lower0, lower1:n1 + lower1]
+
+
+def shift_reference(frame, dy, dx):
+    """frame[y, x] becomes frame[y - dy, x - dx], uncovered pixels are 0"""
+    n0, n1 = frame.shape
+    y, x = np.mgrid[:n0, :n1]
+    inside = (y - dy >= 0) & (y - dy < n0) & (x - dx >= 0) & (x - dx < n1)
+    return np.where(inside, frame[np.clip(y - dy, 0, n0 - 1), np.clip(x - dx, 0, n1 - 1)], 0.)
+
+
+def get_offset_old(scidata, median, std, reference_fit=0):
+    """get_offset before Aligner: full thresholded stack, signal.fftconvolve per frame"""
+    n_fits = scidata.shape[0]
+    offset = np.zeros((n_fits, 2), dtype=int)
+    scidata_threshold = (scidata >= 16. * std[:, None, None] + median[:, None, None]).astype(np.float64)
+
+    for i in range(n_fits):
+        corr = signal.fftconvolve(scidata_threshold[reference_fit], scidata_threshold[i, ::-1, ::-1])
+        offset[i, 0], offset[i, 1] = np.unravel_index(np.argmax(corr), corr.shape)
+
+    return offset - offset[reference_fit]
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(1)
+
+
+def random_offsets(rng, n_fits, max_shift):
+    offset = rng.integers(-max_shift, max_shift + 1, (n_fits, 2))
+    # positive and negative shifts along both axes, and no shift
+    offset[:4] = [[3, -5], [-4, 6], [0, 0], [-7, -2]]
+    return offset
+
+
+@pytest.mark.parametrize("shape", [(40, 56), (57, 31)])
+def test_shift_y_as_old_code(rng, shape):
+    data = rng.normal(100., 10., (12, *shape))
+    offset = random_offsets(rng, len(data), 20)
+    offset[:, 1] = 0
+
+    expected = data.copy()
+    shift_data_old(expected, offset)
+    util.shift_data(data, offset)
+
+    np.testing.assert_array_equal(data, expected)
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_shift_as_reference(rng, dtype):
+    data = rng.normal(100., 10., (12, 45, 38)).astype(dtype)
+    offset = random_offsets(rng, len(data), 25)
+
+    expected = np.array([shift_reference(frame, dy, dx) for frame, (dy, dx) in zip(data, offset)], dtype=dtype)
+    util.shift_data(data, offset)
+
+    np.testing.assert_array_equal(data, expected)
+
+
+def test_shift_x_fixed_old_code_ignored_it(rng):
+    """The old code padded both sides by max(0, dx), so shifts along x were never applied"""
+    data = rng.normal(100., 10., (4, 30, 30))
+    offset = np.array([[0, 4], [0, -4], [2, 3], [-2, -3]])
+
+    old = data.copy()
+    shift_data_old(old, offset)
+    new = data.copy()
+    util.shift_data(new, offset)
+
+    only_y = offset * [1, 0]
+    expected_old = data.copy()
+    util.shift_data(expected_old, only_y)
+    np.testing.assert_array_equal(old, expected_old)
+
+    assert not np.array_equal(new, old)
+    np.testing.assert_array_equal(new[0, :, 4:], data[0, :, :-4])
+    np.testing.assert_array_equal(new[1, :, :-4], data[1, :, 4:])
+
+
+def test_shift_large_offsets_fill(rng):
+    data = rng.normal(100., 10., (2, 20, 20))
+    util.shift_data(data, np.array([[20, 0], [0, -25]]), fill_value=-1.)
+
+    np.testing.assert_array_equal(data, -1.)
+
+
+@pytest.mark.parametrize("reference_fit", [0, 3])
+def test_integer_offsets_as_fftconvolve(rng, reference_fit):
+    n_fits, shape = 8, (96, 80)
+    field = rng.normal(100., 5., shape)
+    stars = rng.integers(8, (shape[0] - 8, shape[1] - 8), (40, 2))
+    field[stars[:, 0], stars[:, 1]] += rng.uniform(500., 2000., len(stars))
+
+    offset = random_offsets(rng, n_fits, 6)
+    scidata = np.array([shift_reference(field, dy, dx) for dy, dx in offset]) + rng.normal(0., 5., (n_fits, *shape))
+    median = np.median(scidata, axis=(1, 2))
+    std = np.std(scidata, axis=(1, 2))
+
+    expected = get_offset_old(scidata, median, std, reference_fit)
+    result = util.get_offset(scidata, median, std, reference_fit)
+
+    np.testing.assert_array_equal(result, expected)
+    # the offsets move every frame back onto the reference
+    np.testing.assert_array_equal(result, offset[reference_fit] - offset)
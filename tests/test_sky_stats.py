@@ -0,0 +1,17 @@
+import numpy as np
+import pytest
+from astropy.stats import sigma_clipped_stats
+
+from sky_stats import MAX_COMPARED, clipped_stats
+
+
+@pytest.mark.parametrize("n_pixels", [MAX_COMPARED // 4, 4 * MAX_COMPARED])
+def test_float32_as_sigma_clipped_stats(n_pixels):
+    rng = np.random.default_rng(3)
+    samples = rng.normal(1000., 20., (3, n_pixels)) + (rng.random((3, n_pixels)) < 0.02) * 5000.
+    samples = samples.astype(np.float32)
+
+    result = np.array(clipped_stats(samples))
+    expected = np.array([sigma_clipped_stats(row.astype(np.float64)) for row in samples]).T
+    assert result.dtype == np.float64
+    np.testing.assert_allclose(result, expected, rtol=1e-9)
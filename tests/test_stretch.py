@@ -0,0 +1,17 @@
+import numpy as np
+
+from sky_stats import clipped_stats
+from stretch import Stretch
+
+
+def test_black_point_at_given_sky():
+    frame = np.random.default_rng(0).normal(100., 5., (256, 256))
+    frame[100:103, 100:103] = 5000.
+    _, median, _ = clipped_stats(frame.reshape(1, -1))
+
+    stretch = Stretch(frame, median[0])
+    assert stretch.default_points() == (median[0], frame.max())
+
+    # without a sky, the median of the histogram, one quantization step apart
+    histogram_median, _ = Stretch(frame).default_points()
+    assert abs(histogram_median - np.median(frame)) <= 1 / stretch.scale
@@ -1,148 +1,374 @@
 import numpy as np
-from astropy.io import fits
 from astropy.stats import sigma_clipped_stats
 from photutils.detection import DAOStarFinder
-from scipy import signal
+from photutils.geometry import circular_overlap_grid
+from scipy import fft, ndimage
+from scipy.spatial import cKDTree
 
+from executor import map_frames, n_workers
+from frame_source import FrameSource
+from sky_stats import clipped_stats, sky_stats
+
+import sys
+import tempfile
+from itertools import repeat
 from pathlib import Path
+from typing import Callable, Optional
+
 
-# converts the fits given in fit_list into arrays
-def fits_to_array(fit_list: list[Path]) -> np.ndarray:
+def allocate_stack(shape: tuple, path_scratch: Optional[Path | str] = None, dtype=np.float64) -> np.ndarray:
     """
-    Gets data from all files in fit_list and returns them as array
-    Data will be flipped to mimic view through telescope
+    Allocates an array for a stack of frames
+    If path_scratch is given, the array is backed by an (anonymous) temporary file in this directory,
+    so the stack does not need to be resident in memory
     """
 
-    return np.array([np.flip(fits.getdata(fit_name, 0)) for fit_name in fit_list])
+    if path_scratch is None:
+        return np.empty(shape, dtype=dtype)
+
+    Path(path_scratch).mkdir(parents=True, exist_ok=True)
+    return np.memmap(tempfile.TemporaryFile(dir=path_scratch), dtype=dtype, mode="w+", shape=shape)
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak resident memory of this process in MB, None if not available on this platform"""
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
 
 
 # creates the median of the given list
-def create_master(frame_list: np.ndarray, median: bool = True) -> np.ndarray:
-    if np.shape(frame_list)[0] > 1:
-        if median:
-            master_frame = np.median(frame_list, axis=0)
-        else:
-            master_frame = np.mean(frame_list, axis=0)
-    else:
-        master_frame = frame_list[0]
+def create_master(frame_list: np.ndarray | FrameSource, method: str = "median", rows_per_tile: int = 256,
+                  out: Optional[np.ndarray] = None, progress: Optional[Callable[[int], None]] = None) -> np.ndarray:
+    """
+    Combines the frames of frame_list (array or FrameSource) to one master frame
+    method: "median", "mean" or "sigma_clip" (mean after 3 sigma clipping)
+    The stack is processed in blocks of rows_per_tile rows, which are read from (memory-mapped) frame_list
+    and written into out, so memory is bounded by the tile size instead of the size of the stack
+    progress(n_rows_done) is called after each block
+    """
+
+    if len(frame_list) <= 1:
+        return frame_list[0]
+
+    n_rows, n_cols = frame_list.shape[1:]
 
-    return master_frame
+    # the master has the dtype of the frames
+    if out is None:
+        out = np.empty((n_rows, n_cols), dtype=frame_list.dtype)
 
+    for start in range(0, n_rows, rows_per_tile):
+        stop = min(start + rows_per_tile, n_rows)
 
-# user can choose pictures for the dark frame correction
-def dark_correction(scidata: np.ndarray, scidata_dark: np.ndarray) -> np.ndarray:
-    return scidata - create_master(scidata_dark)
+        if isinstance(frame_list, FrameSource):
+            block = frame_list.rows(start, stop)
+        else:
+            block = frame_list[:, start:stop]
+
+        match method:
+            case "median":
+                out[start:stop] = np.median(block, axis=0)
+            case "mean":
+                out[start:stop] = np.mean(block, axis=0)
+            case "sigma_clip":
+                out[start:stop] = sigma_clipped_stats(block, sigma=3.0, axis=0)[0]
+            case _:
+                raise ValueError(f"Unknown combine method {method}")
 
+        if progress is not None:
+            progress(stop)
 
-# creates a flat corrected scidata with raw scidata and the scidata from the flat-fits
-def flat_correction(scidata: np.ndarray, scidata_flats: np.ndarray) -> np.ndarray:
-    """Made Method non-mutable"""
+    return out
 
-    master_flat = create_master(scidata_flats)
-    median_flat = np.median(master_flat)
 
-    master_flat /= median_flat
+# normalized master flat
+def master_flat(scidata_flats: np.ndarray | FrameSource, rows_per_tile: int = 256) -> np.ndarray:
+    master = create_master(scidata_flats, rows_per_tile=rows_per_tile)
 
-    return scidata / master_flat
+    return master / np.median(master)
 
 
 def get_fits_names(path_to_fits: Path | str) -> list[Path]:
     return sorted(Path(path_to_fits).glob("*.fit?", case_sensitive=False))
 
 
-def detect_star(n_stars_min, scidata, median, std, FWHM, ratio_gauss, factor_threshold):
-    sources = []
+def match_sources(source_xy: list[np.ndarray], tolerance: float = 4) -> np.ndarray:
+    """
+    Merges the source positions of all frames into one list of distinct stars
+    A source is a new star, if no star already in the list lies within tolerance in x and in y.
+    Frames and sources are visited in the given order, the first source found for a star defines its position
+    """
 
-    n_fits = scidata.shape[0]
+    list_stars = np.empty([0, 2])
 
-    for i in range(n_fits):
-        data = scidata[i, :, :]
-        # init mask with True
-        mask = np.ones(data.shape, dtype=bool)
-        # set everything between 10 und -10 to False, i.e. not masked
-        mask[10:-10, 10:-10] = False
-        daofind = DAOStarFinder(threshold=factor_threshold * std[i], fwhm=FWHM, ratio=ratio_gauss, exclude_border=True, peakmax=48000)
-        sources.append(daofind(data - median[i], mask=mask))
+    for xy in source_xy:
+        if len(xy) == 0:
+            continue
 
-    for i in range(n_fits):
-        sources[i].sort(['peak'])
-        sources[i].reverse()
+        # sources not matching any star of previous frames
+        if len(list_stars) > 0:
+            n_matches = cKDTree(list_stars).query_ball_point(xy, r=tolerance, p=np.inf, return_length=True)
+            candidates = xy[n_matches == 0]
+        else:
+            candidates = xy
 
-    list_stars = np.empty([0, 2])
+        # sources of the same frame may match each other: the first one wins
+        keep = np.ones(len(candidates), dtype=bool)
+        pairs = cKDTree(candidates).query_pairs(r=tolerance, p=np.inf, output_type='ndarray')
+        if len(pairs) > 0:
+            # sorted by later source, so keep[i] is final when pair (i, j) is visited
+            for i, j in pairs[np.lexsort((pairs[:, 0], pairs[:, 1]))]:
+                if keep[i]:
+                    keep[j] = False
 
-    for i_fits in range(n_fits):
-        for i_stars_new in range(len(sources[i_fits])):
-            new_star_in_list = False
-            for i_stars_old in range(len(list_stars)):
-                if abs(sources[i_fits]['xcentroid'][i_stars_new] - list_stars[i_stars_old, 0]) <= 4 and abs(
-                        sources[i_fits]['ycentroid'][i_stars_new] - list_stars[i_stars_old, 1]) <= 4:
-                    new_star_in_list = True
-                    break
-            if not new_star_in_list:
-                list_stars = np.r_[list_stars, np.array(
-                    [[sources[i_fits]['xcentroid'][i_stars_new], sources[i_fits]['ycentroid'][i_stars_new]]])]
-
-    star_in_fits = np.zeros((len(list_stars), n_fits), dtype=bool)
+        list_stars = np.r_[list_stars, candidates[keep]]
 
-    for i_fits in range(n_fits):
-        for i_star_list in range(len(list_stars)):
-            for i_stars_fits in range(len(sources[i_fits])):
-                if abs(sources[i_fits]['xcentroid'][i_stars_fits] - list_stars[i_star_list, 0]) <= 4 and abs(
-                        sources[i_fits]['ycentroid'][i_stars_fits] - list_stars[i_star_list, 1]) <= 4:
-                    star_in_fits[i_star_list, i_fits] = True
-                    break
+    return list_stars
+
+
+def first_matches(source_xy: list[np.ndarray], list_stars: np.ndarray, tolerance: float = 4) -> np.ndarray:
+    """
+    Returns for each star of list_stars and each frame the index of the first source within tolerance
+    -1 marks stars not found in a frame
+    """
+
+    n_fits = len(source_xy)
+    first_match = np.full((len(list_stars), n_fits), -1, dtype=np.intp)
+
+    if len(list_stars) == 0:
+        return first_match
+
+    star_tree = cKDTree(list_stars)
+
+    for i_fits, xy in enumerate(source_xy):
+        if len(xy) == 0:
+            continue
+
+        pairs = cKDTree(xy).sparse_distance_matrix(star_tree, tolerance, p=np.inf, output_type='ndarray')
+        first = np.full(len(list_stars), len(xy), dtype=np.intp)
+        np.minimum.at(first, pairs['j'], pairs['i'])
+        first_match[first < len(xy), i_fits] = first[first < len(xy)]
+
+    return first_match
+
+
+def shift_frame(frame, offset, buffer, fill_value=0., order=1):
+    """
+    Shifts frame in place by offset (dy, dx): frame[y, x] becomes frame[y - dy, x - dx], uncovered pixels get fill_value
+    buffer is a preallocated array of the shape of frame, so no temporaries are created per frame.
+    Non-integer offsets are interpolated by scipy.ndimage.shift (spline of given order)
+    """
+    dy, dx = offset
+
+    if dy != int(dy) or dx != int(dx):
+        ndimage.shift(frame, (dy, dx), output=buffer, order=order, mode="constant", cval=fill_value)
+        frame[...] = buffer
+        return
+
+    dy, dx = int(dy), int(dx)
+    n0, n1 = frame.shape
+
+    if dy == 0 and dx == 0:
+        return
+
+    if abs(dy) >= n0 or abs(dx) >= n1:
+        frame[...] = fill_value
+        return
+
+    # destination, source and uncovered slices for one axis
+    def slices(d, n):
+        return (slice(d, n), slice(0, n - d), slice(0, d)) if d >= 0 else (slice(0, n + d), slice(-d, n), slice(n + d, n))
+
+    dst0, src0, fill0 = slices(dy, n0)
+    dst1, src1, fill1 = slices(dx, n1)
+
+    # source and destination overlap: copy through the buffer
+    region = buffer[:n0 - abs(dy), :n1 - abs(dx)]
+    region[...] = frame[src0, src1]
+    frame[dst0, dst1] = region
+
+    frame[fill0, :] = fill_value
+    frame[:, fill1] = fill_value
+
+
+def shift_data(data, offset, fill_value=0., order=1):
+    """Shifts the frames of data in place by offset (one (dy, dx) per frame), see shift_frame"""
+    buffer = np.empty(data.shape[1:], dtype=data.dtype)
+
+    for frame, frame_offset in zip(data, offset):
+        shift_frame(frame, frame_offset, buffer, fill_value, order)
 
-    list_star_new = np.empty([0, 2])
 
-    for i_star in range(len(list_stars)):
-        if not (False in star_in_fits[i_star, :]):
-            list_star_new = np.r_[list_star_new, np.array([[list_stars[i_star, 0], list_stars[i_star, 1]]])]
+def find_stars(data, median, std, FWHM, ratio_gauss, factor_threshold):
+    """
+    DAOStarFinder sources of one frame sorted by peak (brightest first), a border of 10 pixels is excluded
+    Returns the source table and the centroids as (n, 2) array. The centroids are extracted here,
+    as column aliases of the table may not survive the transfer from a worker process
+    """
+    # init mask with True
+    mask = np.ones(data.shape, dtype=bool)
+    # set everything between 10 und -10 to False, i.e. not masked
+    mask[10:-10, 10:-10] = False
+    daofind = DAOStarFinder(threshold=factor_threshold * std, fwhm=FWHM, ratio=ratio_gauss, exclude_border=True, peakmax=48000)
+    sources = daofind(data - median, mask=mask)
+
+    sources.sort(['peak'])
+    sources.reverse()
+
+    return sources, np.column_stack((sources['xcentroid'], sources['ycentroid']))
+
+
+def detect_star(n_stars_min, scidata, median, std, FWHM, ratio_gauss, factor_threshold, executor=None, progress=None):
+    n_fits = scidata.shape[0]
+
+    sources, source_xy = zip(*map_frames(executor, find_stars, scidata, median, std,
+                                         repeat(FWHM, n_fits), repeat(ratio_gauss, n_fits), repeat(factor_threshold, n_fits),
+                                         progress=progress))
+    sources = list(sources)
+
+    list_stars = match_sources(source_xy)
+    first_match = first_matches(source_xy, list_stars)
+
+    # only keep stars which were found in every fits
+    in_all_fits = np.all(first_match >= 0, axis=1)
+    list_star_new = list_stars[in_all_fits]
+    first_match = first_match[in_all_fits]
 
     if len(list_star_new) < n_stars_min:
-        print('')
-        print(
-            '##########################################################################################################################')
-        print(
-            'Not enough stars detected (%i). Please reduce the minimum number of stars or check input parameters like FWHM or threshold.' % len(
-                list_star_new))
-        print('Another possibility is that some of your images are bad and you have to remove them from the stack.')
-        print(
-            '##########################################################################################################################')
-        print('')
-        exit()
+        raise RuntimeError(
+            'Not enough stars detected (%i). Please reduce the minimum number of stars or check input parameters like FWHM or threshold.\n'
+            'Another possibility is that some of your images are bad and you have to remove them from the stack.' % len(list_star_new))
     else:
         n_stars_min = len(list_star_new)
 
     positions = np.zeros((n_fits, n_stars_min, 2))
 
-    for i_star in range(n_stars_min):
-        for i_fits in range(n_fits):
-            for l in range(len(sources[i_fits])):
-                if abs(sources[i_fits]['xcentroid'][l] - list_star_new[i_star, 0]) <= 4 and abs(
-                        sources[i_fits]['ycentroid'][l] - list_star_new[i_star, 1]) <= 4:
-                    positions[i_fits, i_star, 0] = sources[i_fits]['xcentroid'][l]
-                    positions[i_fits, i_star, 1] = sources[i_fits]['ycentroid'][l]
-                    break
+    for i_fits in range(n_fits):
+        positions[i_fits] = source_xy[i_fits][first_match[:, i_fits]]
 
     return sources, n_stars_min, positions
 
 
-# for alignment of the stars -> offset
-def get_offset(scidata, median, std, reference_fit=0):
-    n_fits = scidata.shape[0]
-    pixel = scidata.shape[1:]
+def threshold_frame(data, median, std):
+    """1 for pixels brighter than 16 sigma above the median, 0 otherwise"""
+    return (data >= 16. * std + median).astype(np.float32)
+
+
+def parabola_peak(c_minus, c_0, c_plus) -> float:
+    """Sub-pixel position of the maximum of a parabola through three neighbouring values, relative to the middle one"""
+    denominator = c_minus - 2 * c_0 + c_plus
+    return 0.5 * (c_minus - c_plus) / denominator if denominator != 0 else 0.
+
+
+class Aligner:
+    """
+    Cross correlation of thresholded frames with a thresholded reference frame
+    The spectrum of the reference is computed once (real FFT, padded to a fast size) and reused for every frame.
+    With downsample > 1 the correlation is searched on binned images first and refined at full resolution
+    by counting coinciding bright pixels around the coarse peak.
+    With subpixel the peak is interpolated by a parabola in each direction.
+    Calling an instance with a frame returns its lag (dy, dx) against the reference.
+    """
 
-    offset = np.zeros((n_fits, 2), dtype=int)
-    scidata_threshold = np.zeros((n_fits, pixel[0], pixel[1]), dtype=np.float64)
+    def __init__(self, reference, median, std, downsample: int = 1, subpixel: bool = False):
+        self.downsample = downsample
+        self.subpixel = subpixel
+
+        reference_threshold = threshold_frame(reference, median, std)
+        self.frame_shape = reference_threshold.shape
+        self.reference_points = np.sort(np.flatnonzero(reference_threshold))
+
+        coarse = self.binned(reference_threshold)
+        self.shape = coarse.shape
+        self.fft_shape = tuple(fft.next_fast_len(2 * n - 1, real=True) for n in self.shape)
+        self.reference_spectrum = fft.rfft2(coarse, self.fft_shape)
+
+        # maps lags -(n - 1) ... n - 1 from the circular correlation to ascending order (as signal.fftconvolve)
+        self.lag_index = tuple(np.r_[size - n + 1:size, 0:n] for n, size in zip(self.shape, self.fft_shape))
+
+    def binned(self, image):
+        """Sum over blocks of downsample x downsample pixels"""
+        if self.downsample == 1:
+            return image
+        d = self.downsample
+        n0, n1 = image.shape[0] // d, image.shape[1] // d
+        return image[:n0 * d, :n1 * d].reshape(n0, d, n1, d).sum(axis=(1, 3))
+
+    def correlate(self, image):
+        """Cross correlation with the reference, element [n0 - 1, n1 - 1] belongs to lag 0"""
+        spectrum = fft.rfft2(image, self.fft_shape)
+        np.conjugate(spectrum, out=spectrum)
+        spectrum *= self.reference_spectrum
+        corr = fft.irfft2(spectrum, self.fft_shape)
+        del spectrum
+
+        # values are counts of coinciding pixels: rounding removes the FFT noise deciding between equal peaks
+        corr = corr[np.ix_(*self.lag_index)]
+        return np.round(corr, out=corr)
+
+    def overlap(self, points, lag) -> int:
+        """Number of bright pixels (flat indices in points) coinciding with bright reference pixels after shifting by lag"""
+        n0, n1 = self.frame_shape
+        y, x = np.divmod(points, n1)
+        y = y + lag[0]
+        x = x + lag[1]
+        inside = (y >= 0) & (y < n0) & (x >= 0) & (x < n1)
+        shifted = y[inside] * n1 + x[inside]
+
+        idx = np.searchsorted(self.reference_points, shifted)
+        idx[idx == len(self.reference_points)] = 0
+        return np.count_nonzero(self.reference_points[idx] == shifted) if len(self.reference_points) else 0
+
+    @staticmethod
+    def peak(corr, center) -> tuple[np.ndarray, np.ndarray]:
+        """Position of the maximum of corr relative to center and its index in corr"""
+        peak = np.array(np.unravel_index(np.argmax(corr), corr.shape))
+        return peak - center, peak
+
+    def __call__(self, data, median, std) -> np.ndarray:
+        image = threshold_frame(data, median, std)
+        corr = self.correlate(self.binned(image))
+        lag, peak = self.peak(corr, np.array(self.shape) - 1)
+
+        if self.downsample > 1:
+            # the coarse lag is only known up to one block: count coincidences around it at full resolution
+            d = self.downsample
+            points = np.flatnonzero(image)
+            window = np.arange(-d, d + 1)
+            corr = np.array([[self.overlap(points, (lag[0] * d + i, lag[1] * d + j)) for j in window] for i in window])
+            fine_lag, peak = self.peak(corr, np.array([d, d]))
+            lag = lag * d + fine_lag
+
+        if not self.subpixel:
+            return lag
+
+        lag = lag.astype(np.float64)
+        for axis in range(2):
+            index = list(peak)
+            if 0 < peak[axis] < corr.shape[axis] - 1:
+                index[axis] = peak[axis] - 1
+                c_minus = corr[tuple(index)]
+                index[axis] = peak[axis] + 1
+                c_plus = corr[tuple(index)]
+                lag[axis] += parabola_peak(c_minus, corr[tuple(peak)], c_plus)
+
+        return lag
 
-    scidata_threshold[:, :, :] = scidata[:, :, :]
 
-    for i in range(n_fits):
-        scidata_threshold[i, scidata_threshold[i] < 16. * std[i] + median[i]] = 0
-        scidata_threshold[i, scidata_threshold[i] >= 16. * std[i] + median[i]] = 1
+# for alignment of the stars -> offset
+def get_offset(scidata, median, std, reference_fit=0, executor=None, progress=None, downsample: int = 1, subpixel: bool = False):
+    """
+    Offsets (dy, dx) of all frames relative to scidata[reference_fit], see Aligner
+    Integer offsets, unless subpixel
+    """
+    aligner = Aligner(scidata[reference_fit], median[reference_fit], std[reference_fit], downsample, subpixel)
 
-        corr = signal.fftconvolve(scidata_threshold[reference_fit], scidata_threshold[i, ::-1, ::-1])
-        offset[i, 0], offset[i, 1] = np.unravel_index(np.argmax(corr), corr.shape)
+    offset = np.array(map_frames(executor, aligner, scidata, median, std, progress=progress))
 
     reference = offset[reference_fit]
     offset = offset - reference
@@ -150,43 +376,118 @@ def get_offset(scidata, median, std, reference_fit=0):
     return offset
 
 
-def get_stats(scidata):
+def get_stats(scidata, executor=None, progress=None, max_pixels=None, method="stride"):
+    """
+    sigma clipped mean, median and standard deviation per frame of a stack (scalars for a single frame)
+    Computed in vectorized chunks of frames, see sky_stats.SkyStats
+    max_pixels: per frame, statistics of a subsample ("stride" or "random", see sky_stats.sample_frames)
+    """
     if scidata.ndim == 3:
-        n_fits = scidata.shape[0]
-        mean, median, std = np.zeros((3, n_fits))
-
-        for i in range(n_fits):
-            mean[i], median[i], std[i] = sigma_clipped_stats(scidata[i, :, :], sigma=3.0)
+        mean, median, std = sky_stats(scidata, executor, progress, max_pixels, method)
 
     elif scidata.ndim == 2:
-        mean, median, std = sigma_clipped_stats(scidata[:, :], sigma=3.0)
+        mean, median, std = (float(v[0]) for v in sky_stats(scidata[None], max_pixels=max_pixels, method=method))
 
     return mean, median, std
 
 
+def photometry(scidata, median, std, positions, radius, annulus=None, gain=1., executor=None, progress=None, chunk=2048,
+               max_pending=None):
+    """
+    Aperture photometry of all stars in all frames, batched over blocks of chunk stars
+    scidata: (n_fits, H, W), positions: (n_fits, n_stars, 2) x, y
+    radius: aperture radius, pixels are weighted by their exact overlap with the aperture (as photutils method="exact")
+    annulus: (inner, outer) radius of the local sky annulus (sigma clipped); None subtracts the global median (std as sky noise)
+    gain: electrons per ADU, for the photon noise of the star
+    Only cutouts around the stars are read, no sky subtracted copy of the frames is made.
+    max_pending: chunks of cutouts gathered ahead of the workers, twice the number of workers of executor if None
+    Returns flux, flux_err and sky (per pixel), each of shape (n_fits, n_stars)
+    """
+    n_fits, n_stars = positions.shape[:2]
+    half = int(np.ceil(annulus[1] if annulus is not None else radius)) + 1
+
+    # cutouts are gathered lazily, at most max_pending chunks ahead of the executor; only they are passed to the workers
+    if max_pending is None:
+        max_pending = 2 * n_workers(executor)
+    starts = range(0, n_stars, chunk)
+    cutouts = (gather_cutouts(scidata, positions[:, start:start + chunk], half) for start in starts)
+
+    n_chunks = len(starts)
+    results = map_frames(executor, cutout_photometry, cutouts, repeat(median, n_chunks), repeat(std, n_chunks),
+                         repeat(radius, n_chunks), repeat(annulus, n_chunks), repeat(gain, n_chunks), progress=progress,
+                         max_pending=max_pending)
+
+    if not results:
+        return np.zeros((3, n_fits, 0))
+
+    return tuple(np.concatenate(columns, axis=1) for columns in zip(*results))
+
+
+def gather_cutouts(scidata, xy, half):
+    """
+    Square cutouts of 2 * half + 1 pixels around the (rounded) positions xy (n_fits, n, 2) of every frame
+    Returns the cutouts (n_fits, n, k, k), the offsets (n_fits, n, 2) x, y of the positions from the centre pixels
+    and a mask of pixels inside the frame
+    """
+    n_fits, height, width = scidata.shape
+    offsets = np.arange(-half, half + 1)
+
+    centre = np.rint(xy).astype(np.intp)
+    x = centre[..., 0, None, None] + offsets[None, :]
+    y = centre[..., 1, None, None] + offsets[:, None]
+    inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
 
-# equalize the histogram for nicer display
-#
-def histeq(im, pixel, n_bins=2 ** 16):
-    imhist, bins = np.histogram(im.flatten(), bins=range(n_bins - 1), density=False)
+    frame = np.arange(n_fits)[:, None, None, None]
+    values = scidata[frame, np.clip(y, 0, height - 1), np.clip(x, 0, width - 1)]
 
-    imhist[0] = 0
+    return values, xy - centre, inside
+
+
+def aperture_weights(offsets, radius, half):
+    """
+    Exact overlap of every pixel of the cutouts with circular apertures (photutils.geometry, as method="exact")
+    offsets: (..., 2) x, y of the aperture centres from the centre pixels of the cutouts of 2 * half + 1 pixels
+    """
+    k = 2 * half + 1
+    weights = np.empty(offsets.shape[:-1] + (k, k))
+
+    for index in np.ndindex(offsets.shape[:-1]):
+        dx, dy = offsets[index]
+        weights[index] = circular_overlap_grid(-half - 0.5 - dx, half + 0.5 - dx, -half - 0.5 - dy, half + 0.5 - dy, k, k, radius, 1, 1)
+
+    return weights
+
+
+def cutout_photometry(cutouts, median, std, radius, annulus, gain):
+    """Flux, its error and the sky of the stars in cutouts (see gather_cutouts)"""
+    values, offsets, inside = cutouts
+    half = values.shape[-1] // 2
+
+    # pixels outside the frame do not count, as in photutils
+    weight = aperture_weights(offsets, radius, half) * inside
+    area = weight.sum(axis=(-2, -1))
+
+    if annulus is None:
+        sky = np.broadcast_to(np.asarray(median, dtype=np.float64)[:, None], area.shape)
+        sky_std = np.broadcast_to(np.asarray(std, dtype=np.float64)[:, None], area.shape)
+        n_sky = np.inf
+    else:
+        # annulus around the rounded position, so it has the same pixels for every star and all rings are clipped at once;
+        # the sigma clipped median is not biased by neighbouring stars in the ring, pixels outside the frame are nan (ignored)
+        ring = np.hypot(*np.mgrid[-half:half + 1, -half:half + 1])
+        ring = (ring >= annulus[0]) & (ring <= annulus[1])
+        sky_pixels = np.where(inside[..., ring], values[..., ring], np.nan)
+        n_sky = np.count_nonzero(inside[..., ring], axis=-1)
 
-    cdf = np.cumsum(imhist)  # cumulative distribution function
-    im2 = np.zeros((len(im.flatten())))
-    s = np.amin(cdf)
-    j = 0
-    for i in im.flatten():
-        i = int(i)
-        im2[j] = np.around(((cdf[i] - s) * (n_bins - 1) / (pixel[0] * pixel[1] - s)))
-        j += 1
-    im2 = im2 / np.amax(im2) * (2 ** 16 - 1)
+        _, sky, sky_std = clipped_stats(sky_pixels.reshape(-1, sky_pixels.shape[-1]))
+        sky = sky.reshape(area.shape)
+        sky_std = sky_std.reshape(area.shape)
 
-    return np.array(im2, dtype=np.float64).reshape(im.shape)
+    flux = (weight * values).sum(axis=(-2, -1)) - area * sky
 
+    # photon noise of the star, sky noise in the aperture and error of the sky estimate
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variance = np.maximum(flux, 0.) / gain + area * sky_std ** 2 + area ** 2 * sky_std ** 2 / n_sky
+    flux_err = np.sqrt(variance)
 
-# log stretch of the histogram for nicer display
-#
-def hist_log(image, scaling_factor=1000, n_bit=16):
-    a = (2 ** n_bit - 1)
-    return a * np.log10( np.maximum(1e-100, scaling_factor * image / a + 1)) / np.log10( scaling_factor)
+    return flux, flux_err, np.asarray(sky)